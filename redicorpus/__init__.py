@@ -2,114 +2,274 @@
 
 from __future__ import absolute_import
 
-from celery.task.control import inspect
 import json
+import os
 from pkg_resources import resource_string
 import pymongo
+import threading
 import warnings
 
 # Global variables for __init__
 STR_TYPE_LIST = ['String', 'Stem', 'Lemma']
 
+# Periods, other than a day, for which Body records are also kept. Any
+# of 'hour', 'week' and 'month'. Records for a newly added week or month
+# period must be built from the daily ones with objects.build_rollups.
+# Hourly records are only written when comments are inserted, and hold
+# users and documents as daily records do. Weekly and monthly records hold
+# HyperLogLog sketches of users and documents rather than sets, so only
+# sketch vectors read them
+ROLLUP_LIST = []
+
+# Number of positions on either side of a gram whose neighbours are
+# counted when comments are inserted, so that a Map can be summed from
+# these counts rather than from every comment holding the gram. Set to 0
+# to stop keeping the counts
+COOCCURRENCE_WINDOW = 5
+
+# Connection string of the MongoDB deployment, unless one is passed to init
+MONGO_URI = os.environ.get('REDICORPUS_MONGO_URI', 'mongodb://localhost:27017/')
+
 # ---
 # Initializing MongoDB
 # ---
 
-c = pymongo.MongoClient()
-# Even though j=True is the default for Mongo, setting this explicitly
-# causes travis builds to fail
+# Connecting, and creating collections and indexes, is put off until the
+# database is first used, so that importing the package has no side
+# effects. Each process holds one pooled MongoClient, and makes a new one
+# if it finds itself forked
+_state = {
+    'client' : None,
+    'pid' : None,
+    'uri' : None,
+    'initialized' : False
+}
+_lock = threading.RLock()
 
-# Set strict write concerns and indices for dictionaries and their counters
-for collection in STR_TYPE_LIST:
 
-    # Create and index counter
-    try:
-        c['Counter'].create_collection(collection,w=2)
-    except pymongo.errors.CollectionInvalid: # if collection already exists
-        pass
-    c['Counter'][collection].create_indexes([
-        pymongo.IndexModel(
-            [('n', pymongo.ASCENDING)], unique=True, background=False
-        )
-    ])
-
-    # Create and index dictionary
-    try:
-        c['Dictionary'].create_collection(collection, w=2)
-    except pymongo.errors.CollectionInvalid:
-        pass
-    c['Dictionary'][collection].create_indexes([
-        pymongo.IndexModel(
-            [('ix', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True, background=False
-        ),
-        pymongo.IndexModel(
-            [('term', pymongo.TEXT)], unique=False, background=False
-        )
-    ])
-
-# Set slack indexing for DictLike and ArrayLike records
-for collection in c['Comment'].collection_names():
-    if 'system' not in collection:
-
-        # Index comments
-        c['Comment'][collection].create_indexes([
-            pymongo.IndexModel(
-                [('_id', pymongo.TEXT)], unique=True, background=True
-            ),
+class LazyClient(object):
+    """Acts like the MongoClient of this process, which is made on first use"""
+
+    def __getattr__(self, name):
+        return getattr(get_client(), name)
+
+    def __getitem__(self, name):
+        return get_client()[name]
+
+    def __repr__(self):
+        return 'LazyClient for {}'.format(_state['uri'] or MONGO_URI)
+
+
+c = LazyClient()
+
+
+def get_client():
+    """Return the MongoClient of this process, connecting and initializing the databases on first use"""
+    with _lock:
+        if _state['client'] is None or _state['pid'] != os.getpid():
+            _state['client'] = pymongo.MongoClient(_state['uri'] or MONGO_URI)
+            _state['pid'] = os.getpid()
+        client = _state['client']
+        if not _state['initialized']:
+            _state['initialized'] = True
+            try:
+                _setup(client)
+            except:
+                _state['initialized'] = False
+                raise
+    return client
+
+
+def init(uri=None, check_celery=False):
+    """
+    Connect to MongoDB, and create any missing collections, indexes, and
+    stopword dictionaries. Calling it again does nothing, unless a new uri
+    is given.
+
+    uri : str
+        MongoDB connection string. Defaults to MONGO_URI
+    check_celery : bool
+        Warn if Celery workers cannot be reached. This can block until the
+        broker times out
+    """
+    with _lock:
+        if uri is not None and uri != _state['uri']:
+            _state['client'] = None
+            _state['uri'] = uri
+            _state['initialized'] = False
+        client = get_client()
+    if check_celery:
+        check_workers()
+    return client
+
+
+def worker_settings():
+    """Return the connection string and settings of this process, to be passed to init_worker in a process it starts"""
+    return {
+        'uri' : _state['uri'] or MONGO_URI,
+        'ROLLUP_LIST' : list(ROLLUP_LIST),
+        'COOCCURRENCE_WINDOW' : COOCCURRENCE_WINDOW
+    }
+
+
+def init_worker(settings):
+    """
+    Give a worker process the connection string and settings of the process
+    that started it, as returned by worker_settings. That process has set up
+    the databases, so setup is skipped.
+    """
+    global ROLLUP_LIST, COOCCURRENCE_WINDOW
+    ROLLUP_LIST = settings['ROLLUP_LIST']
+    COOCCURRENCE_WINDOW = settings['COOCCURRENCE_WINDOW']
+    with _lock:
+        _state['client'] = None
+        _state['uri'] = settings['uri']
+        _state['initialized'] = True
+
+
+def _setup(client):
+    # Even though j=True is the default for Mongo, setting this explicitly
+    # causes travis builds to fail
+
+    from redicorpus.dictionary import TERM_CACHE, find_terms
+
+    _setup_dictionaries(client['Counter'], client['Dictionary'])
+
+    from redicorpus import cache
+
+    # Set slack indexing for DictLike and ArrayLike records
+    for collection in client['Comment'].collection_names():
+        if 'system' not in collection:
+
+            # Index comments
+            client['Comment'][collection].create_indexes([
+                pymongo.IndexModel(
+                    [('_id', pymongo.TEXT)], unique=True, background=True
+                ),
+                pymongo.IndexModel(
+                    [('date', pymongo.DESCENDING)], unique=False, background=True
+                )
+            ])
+
+            # Index corpora
+            client['Body'][collection].create_indexes([
+                pymongo.IndexModel(
+                    [('term', pymongo.TEXT)], unique=False, background=True
+                ),
+                pymongo.IndexModel(
+                    [('n', pymongo.ASCENDING), ('date', pymongo.DESCENDING)], unique=False, background=True
+                )
+            ])
+
+            # Index neighbour counts
+            client['Cooccurrence'][collection].create_indexes([
+                pymongo.IndexModel(
+                    [('term', pymongo.ASCENDING), ('str_type', pymongo.ASCENDING), ('n', pymongo.ASCENDING), ('position', pymongo.ASCENDING), ('date', pymongo.DESCENDING)], unique=False, background=True
+                )
+            ])
+
+            # Index cached vectors and maps
+            cache.ensure_indexes(collection)
+            client['BodyCache'][collection].create_indexes([
+                pymongo.IndexModel(
+                    [('n', pymongo.ASCENDING), ('str_type', pymongo.ASCENDING), ('start_date', pymongo.ASCENDING), ('stop_date', pymongo.DESCENDING)], unique=False, background=True
+                )
+            ])
+
+    # Warming the shared term cache with the ixs the most common ngrams
+    # were given
+    for str_type in STR_TYPE_LIST:
+        for n, stopword_list in _load_stopwords():
+            for term, ix in find_terms(str_type, n, stopword_list).items():
+                TERM_CACHE.set(str_type, n, term, ix)
+
+
+def _load_stopwords():
+    """Return the n of the most common ngrams with their list"""
+    f = resource_string(__name__, 'data/unigrams.json').decode('utf-8')
+    unigrams = json.loads(f)
+    f = resource_string(__name__, 'data/bigrams.json').decode('utf-8')
+    bigrams = json.loads(f)
+    f = resource_string(__name__, 'data/trigrams.json').decode('utf-8')
+    trigrams = json.loads(f)
+    return list(zip([1,2,3], [unigrams, bigrams, trigrams]))
+
+
+def _setup_dictionaries(counters, dictionaries):
+    """Create and index the Counter and Dictionary collections in two databases, and seed them with stopwords"""
+
+    from redicorpus.dictionary import ensure_keys, term_key
+
+    # Set strict write concerns and indices for dictionaries and their counters
+    for collection in STR_TYPE_LIST:
+
+        # Create and index counter
+        try:
+            counters.create_collection(collection,w=2)
+        except pymongo.errors.CollectionInvalid: # if collection already exists
+            pass
+        counters[collection].create_indexes([
             pymongo.IndexModel(
-                [('date', pymongo.DESCENDING)], unique=False, background=True
+                [('n', pymongo.ASCENDING)], unique=True, background=False
             )
         ])
 
-        # Index corpora
-        c['Body'][collection].create_indexes([
+        # Create and index dictionary
+        try:
+            dictionaries.create_collection(collection, w=2)
+        except pymongo.errors.CollectionInvalid:
+            pass
+        ensure_keys(dictionaries[collection])
+        dictionaries[collection].create_indexes([
             pymongo.IndexModel(
-                [('term', pymongo.TEXT)], unique=False, background=True
+                [('ix', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True, background=False
             ),
             pymongo.IndexModel(
-                [('n', pymongo.ASCENDING), ('date', pymongo.DESCENDING)], unique=False, background=True
+                [('term', pymongo.TEXT)], unique=False, background=False
+            ),
+            # One entry for each term, looked up exactly by its key
+            pymongo.IndexModel(
+                [('key', pymongo.ASCENDING), ('n', pymongo.ASCENDING)], unique=True, background=False
             )
         ])
 
-# Initialize Dictionary and Counters with the top 100 most common
-# ngrams. Having these at the start of the numeric index is a lookup
-# efficiency concern
-
-# Loading most common ngrams
-f = resource_string(__name__, 'data/unigrams.json').decode('utf-8')
-unigrams = json.loads(f)
-f = resource_string(__name__, 'data/bigrams.json').decode('utf-8')
-bigrams = json.loads(f)
-f = resource_string(__name__, 'data/trigrams.json').decode('utf-8')
-trigrams = json.loads(f)
-
-# Inserting most common ngrams
-for str_type in STR_TYPE_LIST:
-    for n, stopword_list in zip([1,2,3], [unigrams, bigrams, trigrams]):
-        if not c['Counter'][str_type].find_one({'n' : n}):
-            for ix, term in enumerate(stopword_list):
-                c['Dictionary'][str_type].insert_one({
-                    'ix' : ix,
-                    'term' : term,
-                    'n' : n
+    # Initialize Dictionary and Counters with the top 100 most common
+    # ngrams. Having these at the start of the numeric index is a lookup
+    # efficiency concern. A term listed more than once keeps the ix of its
+    # first entry, and entries left by an interrupted seeding are kept
+    for str_type in STR_TYPE_LIST:
+        for n, stopword_list in _load_stopwords():
+            if not counters[str_type].find_one({'n' : n}):
+                ix_of = {}
+                for ix, term in enumerate(stopword_list):
+                    ix_of.setdefault(term_key(term), (ix, term))
+                for key, (ix, term) in ix_of.items():
+                    dictionaries[str_type].update_one({
+                        'key' : key,
+                        'n' : n
+                    }, {
+                        '$setOnInsert' : {'ix' : ix, 'term' : term}
+                    }, upsert=True)
+                counters[str_type].insert_one({
+                    'n' : n,
+                    'counter' : max([ix for ix, term in ix_of.values()])
                 })
-            c['Counter'][str_type].insert_one({
-                'n' : n,
-                'counter' : len(stopword_list) - 1
-            })
 
 # ---
 # Checking celery
 # ---
 
-try:
-    stats = inspect().stats()
-    if stats:
-        celery_name = list(stats.keys())[0]
-        num_workers = stats[celery_name]['pool']['max-concurrency']
-        if num_workers == 0:
-            warnings.warn("Celery is running without workers\nSome functions may not behave as expected")
-    else:
-        warnings.warn("Celery is not running\nSome functions may not behave as expected")
-except OSError as e:
-    warnings.warn("Connection to Celery broker is closed. Try restarting broker")
+def check_workers():
+    """Warn if the Celery broker or its workers cannot be reached"""
+    from celery.task.control import inspect
+    try:
+        stats = inspect().stats()
+        if stats:
+            celery_name = list(stats.keys())[0]
+            num_workers = stats[celery_name]['pool']['max-concurrency']
+            if num_workers == 0:
+                warnings.warn("Celery is running without workers\nSome functions may not behave as expected")
+        else:
+            warnings.warn("Celery is not running\nSome functions may not behave as expected")
+    except OSError as e:
+        warnings.warn("Connection to Celery broker is closed. Try restarting broker")
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+Offline, two-phase building of Body and Cooccurrence records from comment
+dumps, for backfills too large to upsert one comment at a time.
+
+In the first phase, worker processes tokenize shards of a dump and reduce
+each shard to its updates of every record, which they write to a local run
+file sorted by record. In the second phase, the run files are merged in
+passes of at most MERGE_WIDTH files, updates to the same record are
+combined, and each record is written to MongoDB once, in large unordered
+batches. Comments are inserted as their shards finish.
+
+Builds are meant for comments not yet in the database. Comments already
+stored are skipped when inserted, but are still counted.
+"""
+
+from __future__ import absolute_import
+
+from collections import Counter
+from datetime import datetime, timedelta
+import heapq
+from itertools import groupby
+import json
+import multiprocessing
+import os
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import redicorpus
+from redicorpus import c, cache, snapshot, tools
+from redicorpus.dictionary import DUPLICATE_KEY
+from redicorpus.get import dump
+from redicorpus.objects import Comment, merge_update, body_collection
+import shutil
+import tempfile
+import warnings
+
+# Number of lines of a dump reduced to each run file
+SHARD_SIZE = 20000
+
+# Largest number of run files merged at once
+MERGE_WIDTH = 256
+
+# Number of records written in each batch
+WRITE_SIZE = 10000
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def shard_updates(comment_list, sketch=False):
+    """
+    Return the combined updates of a list of comments to every Body,
+    Cooccurrence, and Coverage record, as a dict of record key to update.
+    Keys are ('Body', source, period, date, str_type, n, term, raw, pos),
+    ('Cooccurrence', source, date, str_type, n, term, position, neighbour),
+    or ('Coverage', source, date)
+    """
+    result = {}
+    periods = ['day'] + list(redicorpus.ROLLUP_LIST)
+    for comment in comment_list:
+        grams = comment.__aggregategrams__()
+        for period in periods:
+            date = tools.round_date(comment['date'], period).strftime(DATE_FORMAT)
+            for (str_type, n, term, raw, pos), count in grams.items():
+                key = ('Body', comment['source'], period, date, str_type, n, term, raw, pos)
+                update = comment.__bodyupdate__(count, sketch, period)
+                result[key] = merge_update(result[key], update) if key in result else update
+        if redicorpus.COOCCURRENCE_WINDOW:
+            date = tools.round_date(comment['date'], 'day').strftime(DATE_FORMAT)
+            for (str_type, n, term, position, neighbour), count in comment.__aggregateneighbours__().items():
+                key = ('Cooccurrence', comment['source'], date, str_type, n, term, position, neighbour)
+                if key in result:
+                    result[key]['$inc']['count'] += count
+                else:
+                    result[key] = {'$inc' : {'count' : count}}
+            key = ('Coverage', comment['source'], date)
+            update = {'$inc' : {'comments' : 1}, '$min' : {'window' : redicorpus.COOCCURRENCE_WINDOW}}
+            result[key] = merge_update(result[key], update) if key in result else update
+    return result
+
+
+def write_run(path, updates):
+    """Write updates to a run file, one JSON [key, update] line per record, sorted by key"""
+    lines = sorted([(json.dumps(key), json.dumps(update)) for key, update in updates.items()])
+    with open(path, 'w') as f:
+        for key, update in lines:
+            f.write('{}\t{}\n'.format(key, update))
+
+
+def read_run(path):
+    """Yield (key, update) of each line of a run file, with the key still encoded"""
+    with open(path) as f:
+        for line in f:
+            key, update = line.rstrip('\n').split('\t', 1)
+            yield key, json.loads(update)
+
+
+def merge_runs(path_list):
+    """Yield (key, update) for each record of sorted run files, combining updates to the same record"""
+    for key, group in groupby(heapq.merge(*[read_run(path) for path in path_list], key=lambda item: item[0]), key=lambda item: item[0]):
+        update = None
+        for _, other in group:
+            update = other if update is None else merge_update(update, other)
+        yield key, update
+
+
+def map_shard(args):
+    """
+    Tokenize a shard of a dump, write its run file, and return the comments
+    as documents, with the number of records skipped
+    """
+    lines, source, sketch, path = args
+    comment_list, skipped = dump.comments(lines, source)
+    write_run(path, shard_updates(comment_list, sketch))
+    return path, [comment.__todocument__() for comment in comment_list], skipped
+
+
+def insert_documents(documents, dates=None):
+    """
+    Insert comment documents in one unordered batch per source, skipping
+    those already stored. If dates is a dict, it is updated with the first
+    and last date of each source.
+    """
+    by_source = {}
+    for document in documents:
+        by_source.setdefault(document['source'], []).append(document)
+    for source, document_list in by_source.items():
+        if dates is not None:
+            date_list = [document['date'] for document in document_list]
+            low, high = dates.get(source, (min(date_list), max(date_list)))
+            dates[source] = (min([low] + date_list), max([high] + date_list))
+        try:
+            c['Comment'][source].insert_many(document_list, ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details['writeErrors']:
+                if write_error['code'] != DUPLICATE_KEY:
+                    raise
+            warnings.warn("{} comments already in collection {}".format(len(error.details['writeErrors']), source))
+
+
+def load(records):
+    """Write (key, update) records to their collections, and their terms to the Dictionary, in batches"""
+    requests = {}
+    grams = Counter()
+    count = 0
+    for key, update in records:
+        key = json.loads(key)
+        if key[0] == 'Body':
+            _, source, period, date, str_type, n, term, raw, pos = key
+            collection = body_collection(source, period)
+            record = {'date' : datetime.strptime(date, DATE_FORMAT), 'term' : term, 'raw' : raw, 'pos' : pos, 'n' : n, 'str_type' : str_type}
+            grams[(str_type, n, tuple(term), tuple(raw), tuple(pos))] += 1
+        elif key[0] == 'Coverage':
+            _, source, date = key
+            collection = c['Coverage'][source]
+            record = {'_id' : datetime.strptime(date, DATE_FORMAT)}
+        else:
+            _, source, date, str_type, n, term, position, neighbour = key
+            collection = c['Cooccurrence'][source]
+            record = {'date' : datetime.strptime(date, DATE_FORMAT), 'term' : term, 'position' : position, 'neighbour' : neighbour, 'n' : n, 'str_type' : str_type}
+        requests.setdefault((collection.database.name, collection.name), (collection, []))[1].append(UpdateOne(record, update, upsert=True))
+        count += 1
+        if count % WRITE_SIZE == 0:
+            _flush(requests, grams)
+    _flush(requests, grams)
+    return count
+
+
+def _flush(requests, grams):
+    """Write pending Dictionary entries and record updates"""
+    Comment.__bulkupdatedictionary__(grams)
+    grams.clear()
+    for collection, request_list in requests.values():
+        if request_list:
+            collection.bulk_write(request_list, ordered=False)
+    requests.clear()
+
+
+def build_corpus(path, source=None, processes=None, sketch=False, shard_size=SHARD_SIZE, work_dir=None):
+    """
+    Build the Body and Cooccurrence records, and Dictionary entries, of a
+    dump in two phases, and insert its comments. Returns the number of
+    records written.
+
+    source : str
+        Source of every comment. Defaults to the subreddit of each record
+    processes : int
+        Number of worker processes. Defaults to the number of cores
+    work_dir : str
+        Directory for run files, which are removed when the build ends.
+        Defaults to the system temporary directory
+    """
+    run_dir = tempfile.mkdtemp(prefix='redicorpus-', dir=work_dir)
+    try:
+        tasks = ((lines, source, sketch, os.path.join(run_dir, '{:08d}.run'.format(line))) for line, lines in dump.chunks(path, 0, shard_size))
+        path_list = []
+        dates = {}
+        skipped = 0
+        with multiprocessing.Pool(processes) as pool:
+            for run_path, documents, shard_skipped in pool.imap_unordered(map_shard, tasks):
+                insert_documents(documents, dates)
+                path_list.append(run_path)
+                skipped += shard_skipped
+        if skipped:
+            warnings.warn("{} records of {} could not be read, and were skipped".format(skipped, path))
+        generation = 0
+        while len(path_list) > MERGE_WIDTH:
+            generation += 1
+            merged = []
+            for i in range(0, len(path_list), MERGE_WIDTH):
+                merged_path = os.path.join(run_dir, 'merge-{}-{:08d}.run'.format(generation, i))
+                with open(merged_path, 'w') as f:
+                    for key, update in merge_runs(path_list[i:i + MERGE_WIDTH]):
+                        f.write('{}\t{}\n'.format(key, json.dumps(update)))
+                merged.append(merged_path)
+            for run_path in path_list:
+                os.remove(run_path)
+            path_list = merged
+        count = load(merge_runs(path_list))
+        for source, (start_date, stop_date) in dates.items():
+            cache.invalidate(source, start_date, stop_date + timedelta(0, 0, 1))
+            snapshot.touch(source, start_date, stop_date + timedelta(0, 0, 1))
+        return count
+    finally:
+        shutil.rmtree(run_dir)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='Newline-delimited JSON dump, optionally compressed with gzip, bzip2, or xz')
+    parser.add_argument('--source', default=None, help='Source of every comment. Defaults to the subreddit of each')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--work-dir', default=None, help='Directory for intermediate run files')
+    args = parser.parse_args()
+
+    print(build_corpus(args.path, args.source, args.processes, work_dir=args.work_dir))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Bounds, eviction, invalidation, and metrics for the BodyCache and Map
+databases of pre-computed vectors and maps
+"""
+
+from __future__ import absolute_import
+
+from bson import BSON
+from datetime import datetime
+import pymongo
+from redicorpus import c
+
+# Databases managed as caches, with one collection per source
+CACHE_DATABASES = ['BodyCache', 'Map']
+
+# Seconds after its last use that an entry expires
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of bytes held by each collection
+CACHE_SIZE = 2 ** 30
+
+# Entries evicted first when a collection is over its size. One of 'lru'
+# (least recently used) or 'lfu' (least frequently used)
+CACHE_POLICY = 'lru'
+
+# Database of the running number of bytes held by each cache collection,
+# with one collection per cache database and one document per source
+SIZE_DATABASE = 'CacheSize'
+
+_metrics = {}
+
+
+def _metrics_of(collection):
+    key = (collection.database.name, collection.name)
+    if key not in _metrics:
+        _metrics[key] = {'hits' : 0, 'misses' : 0}
+    return _metrics[key]
+
+
+def ensure_indexes(source):
+    """Create expiry and lookup indexes for the caches of source"""
+    for database in CACHE_DATABASES:
+        c[database][source].create_indexes([
+            pymongo.IndexModel(
+                [('accessed', pymongo.ASCENDING)], expireAfterSeconds=CACHE_TTL, background=True
+            ),
+            pymongo.IndexModel(
+                [('start_date', pymongo.ASCENDING), ('stop_date', pymongo.DESCENDING)], unique=False, background=True
+            )
+        ])
+
+
+def prepare(document):
+    """Add access time, hit count, and size in bytes to a document before it is cached"""
+    document['accessed'] = datetime.utcnow()
+    document['hits'] = 0
+    document['size'] = 0
+    document['size'] = len(BSON.encode(document))
+    return document
+
+
+def store(collection, document, query=None, upsert=True):
+    """
+    Insert a prepared document into a cache collection, or replace the
+    entry matching query with it, and add the difference in size to the
+    running size of the collection
+    """
+    if query is None:
+        collection.insert_one(document)
+        resize(collection, document['size'])
+        return
+    previous = collection.find_one_and_replace(query, document, projection={'size' : 1}, upsert=upsert)
+    if previous or upsert:
+        resize(collection, document['size'] - (previous or {}).get('size', 0))
+
+
+def resize(collection, change):
+    """Add change to the running size of a cache collection"""
+    if change:
+        c[SIZE_DATABASE][collection.database.name].update_one({
+            '_id' : collection.name
+        }, {
+            '$inc' : {'size' : change}
+        }, upsert=True)
+
+
+def running_size(collection):
+    """Return the running size of a cache collection, which counts entries expired by MongoDB until the next eviction"""
+    document = c[SIZE_DATABASE][collection.database.name].find_one({'_id' : collection.name})
+    if document:
+        return document['size']
+    return 0
+
+
+def hit(collection, _id):
+    """Record the use of a cached entry"""
+    _metrics_of(collection)['hits'] += 1
+    collection.update_one({'_id' : _id}, {
+        '$set' : {'accessed' : datetime.utcnow()},
+        '$inc' : {'hits' : 1}
+    })
+
+
+def miss(collection):
+    """Record a lookup that found no cached entry"""
+    _metrics_of(collection)['misses'] += 1
+
+
+def evict(collection, size=CACHE_SIZE, policy=CACHE_POLICY):
+    """
+    Remove entries by policy until the collection holds no more than size
+    bytes. Only the running size is read unless it is over size, when the
+    entries are summed again, and the running size corrected, as it still
+    counts entries expired by MongoDB
+    """
+    if policy == 'lru':
+        order = [('accessed', pymongo.ASCENDING)]
+    elif policy == 'lfu':
+        order = [('hits', pymongo.ASCENDING), ('accessed', pymongo.ASCENDING)]
+    else:
+        raise ValueError("{} is not a valid eviction policy".format(policy))
+    running = running_size(collection)
+    if running <= size:
+        return 0
+    total = size_of(collection)
+    removed = 0
+    for document in collection.find({}, {'size' : 1}, sort=order):
+        if total <= size:
+            break
+        collection.delete_one({'_id' : document['_id']})
+        total -= document.get('size', 0)
+        removed += 1
+    resize(collection, total - running)
+    return removed
+
+
+def invalidate(source, start_date, stop_date=None):
+    """
+    Remove cached entries of source whose range overlaps the dates from
+    start_date until stop_date, or the single date start_date
+    """
+    if stop_date is None:
+        query = {'start_date' : {'$lte' : start_date}, 'stop_date' : {'$gt' : start_date}}
+    else:
+        query = {'start_date' : {'$lt' : stop_date}, 'stop_date' : {'$gt' : start_date}}
+    removed = 0
+    for database in CACHE_DATABASES:
+        collection = c[database][source]
+        documents = list(collection.find(query, {'size' : 1}))
+        if documents:
+            removed += collection.delete_many({'_id' : {'$in' : [document['_id'] for document in documents]}}).deleted_count
+            resize(collection, -sum([document.get('size', 0) for document in documents]))
+    return removed
+
+
+def size_of(collection):
+    """Return number of bytes held by entries of a collection"""
+    for document in collection.aggregate([
+        {'$group' : {'_id' : None, 'size' : {'$sum' : '$size'}}}
+    ]):
+        return document['size']
+    return 0
+
+
+def stats(source):
+    """Return hits, misses, hit rate, entries, and bytes for the caches of source"""
+    result = {}
+    for database in CACHE_DATABASES:
+        collection = c[database][source]
+        metrics = _metrics_of(collection)
+        lookups = metrics['hits'] + metrics['misses']
+        result[database] = {
+            'hits' : metrics['hits'],
+            'misses' : metrics['misses'],
+            'hit_rate' : float(metrics['hits']) / lookups if lookups else None,
+            'entries' : collection.count(),
+            'bytes' : size_of(collection)
+        }
+    return result
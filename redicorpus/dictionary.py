@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+Shared, in-process lookups between grams and their integer indices
+
+Terms are looked up in the term cache, then in the dictionary snapshot of
+their (str_type, n), and only then in the Dictionary database. Snapshots
+are exported periodically with export_snapshot, and hold every term given
+an ix before the export: a term missing from one is either newer, or not
+in the Dictionary at all.
+
+A dictionary snapshot is a snapshot file with three arrays:
+
+    keys, the UTF-8 bytes of each term with its grams joined by SEPARATOR,
+    concatenated in sorted order
+    offsets, where each key starts in keys, and where the last one ends
+    ixs, the ix of each term, in the same order
+"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import sha1
+import numpy as np
+import os
+from pymongo import ASCENDING, InsertOne
+from pymongo.collection import ReturnDocument
+from pymongo.errors import BulkWriteError
+import redicorpus
+from redicorpus import c, snapshot
+import threading
+import time
+
+# Maximum number of terms held for each (str_type, n) pair
+TERM_CACHE_SIZE = 2 ** 20
+
+# Number of ids reserved from a Counter with each increment
+ID_BLOCK_SIZE = 1000
+
+# MongoDB error code for unique index violations
+DUPLICATE_KEY = 11000
+
+MAGIC = b'RCDSNAP1'
+
+# Joins the grams of a term in dictionary snapshots
+SEPARATOR = '\x1f'
+
+# Seconds between checks for a newer export of an open dictionary snapshot
+SNAPSHOT_CHECK_INTERVAL = 60
+
+
+class LRUCache(object):
+    """A bounded mapping that evicts the least recently used key"""
+
+    def __init__(self, maxsize=TERM_CACHE_SIZE):
+        self.data = OrderedDict()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __setitem__(self, key, value):
+        if key in self.data:
+            self.data.move_to_end(key)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self):
+        """Remove all keys and reset counters"""
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return value for key, marking it as recently used"""
+        try:
+            value = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+
+class TermCache(object):
+    """Term to ix cache for each (str_type, n), shared by every ArrayLike"""
+
+    def __init__(self, maxsize=TERM_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.caches = {}
+
+    def __getcache__(self, str_type, n):
+        key = (str_type, n)
+        if key not in self.caches:
+            self.caches[key] = LRUCache(self.maxsize)
+        return self.caches[key]
+
+    def clear(self):
+        """Empty every cache"""
+        for cache in self.caches.values():
+            cache.clear()
+
+    def get(self, str_type, n, term):
+        """Return ix of term, or None if it is not cached"""
+        return self.__getcache__(str_type, n).get(tuple(term))
+
+    def set(self, str_type, n, term, ix):
+        """Cache ix of term"""
+        self.__getcache__(str_type, n)[tuple(term)] = ix
+
+    def stats(self):
+        """Return hits, misses, and size for each (str_type, n)"""
+        return {
+            key : {
+                'hits' : cache.hits,
+                'misses' : cache.misses,
+                'size' : len(cache)
+            } for key, cache in self.caches.items()
+        }
+
+    def warm(self, str_type, n, term_list):
+        """Cache a list of terms whose ix is their position in the list"""
+        cache = self.__getcache__(str_type, n)
+        for ix, term in enumerate(term_list):
+            cache[tuple(term)] = ix
+
+
+class IdAllocator(object):
+    """
+    Hands out dictionary ids from blocks reserved with a single increment of
+    the Counter, so that workers do not contend for the counter on every new
+    term. Ids left in a block when a worker exits are never used.
+    """
+
+    def __init__(self, block_size=ID_BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = {}
+
+    def __reserve__(self, str_type, n):
+        """Reserve the next block of ids as [start, stop)"""
+        counter = c['Counter'][str_type].find_one_and_update({
+            'n' : n
+        }, {
+            '$inc' : {
+                'counter' : self.block_size
+            }
+        }, return_document=ReturnDocument.AFTER)
+        stop = counter['counter'] + 1
+        return [stop - self.block_size, stop]
+
+    def allocate(self, str_type, n):
+        """Return an unused id for str_type and n"""
+        key = (str_type, n)
+        block = self.blocks.get(key)
+        if not block or block[0] >= block[1]:
+            block = self.blocks[key] = self.__reserve__(str_type, n)
+        ix = block[0]
+        block[0] += 1
+        return ix
+
+
+class DictionarySnapshot(object):
+    """Read-only, memory-mapped term to ix table of one (str_type, n), searched by bisection"""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        self.header, arrays = snapshot.read_file(path, MAGIC)
+        self.keys = arrays['keys']
+        self.offsets = arrays['offsets']
+        self.ixs = arrays['ixs']
+
+    def __len__(self):
+        return len(self.ixs)
+
+    def __key__(self, i):
+        return self.keys[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def get(self, term):
+        """Return ix of term, or None if it is not in the snapshot"""
+        key = encode(term)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__key__(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self.__key__(low) == key:
+            return int(self.ixs[low])
+        return None
+
+
+class SnapshotIndex(object):
+    """
+    Opens the dictionary snapshot of each (str_type, n) on first use, and
+    reopens it when a newer export replaces the file
+    """
+
+    def __init__(self, directory=None, interval=SNAPSHOT_CHECK_INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.snapshots = {}
+        self.lock = threading.Lock()
+
+    def __snapshot__(self, str_type, n):
+        """Return the open snapshot of str_type and n, or None if there is none"""
+        key = (str_type, n)
+        now = time.monotonic()
+        current, checked = self.snapshots.get(key, (None, None))
+        if checked is not None and now - checked < self.interval:
+            return current
+        with self.lock:
+            path = snapshot_path(str_type, n, self.directory)
+            try:
+                mtime = os.stat(path).st_mtime
+                if current is None or current.path != path or current.mtime != mtime:
+                    current = DictionarySnapshot(path)
+            except (OSError, ValueError):
+                current = None
+            self.snapshots[key] = (current, now)
+        return current
+
+    def clear(self):
+        """Close every snapshot, so that each is opened again on next use"""
+        with self.lock:
+            self.snapshots.clear()
+
+    def get(self, str_type, n, term):
+        """Return ix of term, or None if it is not in the snapshot of str_type and n"""
+        current = self.__snapshot__(str_type, n)
+        if current is None:
+            return None
+        return current.get(term)
+
+
+TERM_CACHE = TermCache()
+ID_ALLOCATOR = IdAllocator()
+SNAPSHOTS = SnapshotIndex()
+
+
+def encode(term):
+    """Return the key of a term in dictionary snapshots"""
+    return SEPARATOR.join(term).encode('utf-8')
+
+
+def term_key(term):
+    """
+    Return the key of a term in the Dictionary database, a digest of its
+    grams, as array fields cannot hold a unique index on a whole term
+    """
+    return sha1(encode(term)).hexdigest()
+
+
+def ensure_keys(dictionary):
+    """
+    Give every entry of a Dictionary collection written without a key its
+    key, removing entries of a term after the one with its lowest ix, so
+    that the unique (key, n) index can be built
+    """
+    for document in dictionary.find({
+        'key' : {'$exists' : False}
+    }, {
+        'term' : 1, 'ix' : 1, 'n' : 1
+    }).sort('ix', ASCENDING):
+        key = term_key(document['term'])
+        if dictionary.find_one({'key' : key, 'n' : document['n']}, {'ix' : 1}):
+            dictionary.delete_one({'_id' : document['_id']})
+        else:
+            dictionary.update_one({'_id' : document['_id']}, {'$set' : {'key' : key}})
+
+
+def snapshot_path(str_type, n, directory=None):
+    """Return path of the dictionary snapshot of str_type and n"""
+    return os.path.join(directory or snapshot.SNAPSHOT_DIR, 'Dictionary', '{}-{}.dict'.format(str_type, n))
+
+
+def export_snapshot(str_type, n, directory=None):
+    """
+    Write the dictionary snapshot of str_type and n, replacing the last
+    export. Returns the number of terms written.
+    """
+    ix_of = {}
+    max_ix = -1
+    for document in c['Dictionary'][str_type].find({
+        'n' : n
+    }, {
+        'term' : 1, 'ix' : 1
+    }).sort('ix', ASCENDING):
+        key = encode(document['term'])
+        if key not in ix_of:
+            ix_of[key] = document['ix']
+        max_ix = max(max_ix, document['ix'])
+    key_list = sorted(ix_of)
+    offsets = np.zeros(len(key_list) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(key) for key in key_list], dtype=np.uint64)
+    fields = {
+        'str_type' : str_type,
+        'n' : n,
+        'count' : len(key_list),
+        'max_ix' : max_ix,
+        'exported' : datetime.utcnow().strftime(snapshot.DATE_FORMAT)
+    }
+    snapshot.write_file(snapshot_path(str_type, n, directory), fields, [
+        ('keys', np.frombuffer(b''.join(key_list), dtype=np.uint8)),
+        ('offsets', offsets),
+        ('ixs', np.array([ix_of[key] for key in key_list], dtype=np.int64))
+    ], MAGIC)
+    return len(key_list)
+
+
+def lookup(str_type, n, term):
+    """
+    Get integer index of term, checking the shared cache and the dictionary
+    snapshot before the Dictionary database. Returns None if the term is in
+    none of them.
+    """
+    ix = TERM_CACHE.get(str_type, n, term)
+    if ix is None:
+        ix = SNAPSHOTS.get(str_type, n, term)
+        if ix is None:
+            document = c['Dictionary'][str_type].find_one({
+                'key' : term_key(term),
+                'n' : n
+            })
+            if document:
+                ix = document['ix']
+        if ix is not None:
+            TERM_CACHE.set(str_type, n, term, ix)
+    return ix
+
+
+def find_terms(str_type, n, term_list):
+    """Return a dict of term to ix for the terms of a list that are in the Dictionary"""
+    result = {}
+    for document in c['Dictionary'][str_type].find({
+        'key' : {'$in' : [term_key(term) for term in term_list]},
+        'n' : n
+    }, {
+        'term' : 1, 'ix' : 1
+    }):
+        result[tuple(document['term'])] = document['ix']
+    return result
+
+
+def insert_terms(str_type, n, term_list):
+    """
+    Give each term an id from the local block and insert it into the
+    Dictionary. The unique (key, n) index keeps a single entry for each
+    term, so when racing workers insert the same term, the first insert
+    wins and the others read its ix. Ids that collide on the unique (ix, n)
+    index are replaced and retried. Only ixs read back from the Dictionary
+    are cached and returned, as a dict of term to ix.
+    """
+    dictionary = c['Dictionary'][str_type]
+    pending = set([tuple(term) for term in term_list])
+    result = {}
+    while pending:
+        try:
+            dictionary.bulk_write([InsertOne({
+                'ix' : ID_ALLOCATOR.allocate(str_type, n),
+                'term' : list(term),
+                'key' : term_key(term),
+                'n' : n
+                }) for term in pending], ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details['writeErrors']:
+                if write_error['code'] != DUPLICATE_KEY:
+                    raise
+        found = find_terms(str_type, n, pending)
+        result.update(found)
+        pending.difference_update(found)
+    for term, ix in result.items():
+        TERM_CACHE.set(str_type, n, term, ix)
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--directory', default=None, help='Directory of snapshots. Defaults to the snapshot directory')
+    args = parser.parse_args()
+
+    for str_type in redicorpus.STR_TYPE_LIST:
+        for n in [1, 2, 3]:
+            print(str_type, n, export_snapshot(str_type, n, args.directory))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+"""
+Bulk import of newline-delimited JSON comment dumps, such as the monthly
+Reddit archives, which may be compressed with gzip, bzip2, or xz.
+
+Records are translated and tokenized in a process pool, and inserted in
+large batches whose Dictionary and Body updates are combined. The line
+reached is checkpointed after each batch, so an interrupted import resumes
+where it left off. The updates of a batch are written before its comments,
+so a batch interrupted between the two has its comments counted when it
+is imported again, and updates of some of them may be applied twice, but
+none are lost.
+"""
+
+from __future__ import absolute_import
+
+import bz2
+import gzip
+from itertools import islice
+import json
+import lzma
+import multiprocessing
+import os
+from redicorpus import c, objects
+from redicorpus.get import reddit
+import warnings
+
+# Number of lines translated by a worker at a time
+CHUNK_SIZE = 500
+
+# Number of comments inserted in each batch, and between checkpoints
+BATCH_SIZE = 10000
+
+OPENERS = {
+    '.bz2' : bz2.open,
+    '.gz' : gzip.open,
+    '.xz' : lzma.open
+}
+
+
+def open_dump(path):
+    """Open a dump for reading text, decompressing it by its extension"""
+    opener = OPENERS.get(os.path.splitext(path)[1], open)
+    return opener(path, 'rt', encoding='utf-8')
+
+
+def get_checkpoint(path):
+    """Return the number of lines of a dump already imported"""
+    document = c['Comment']['ImportCheckpoint'].find_one({'path' : os.path.abspath(path)})
+    if document:
+        return document['line']
+    return 0
+
+
+def set_checkpoint(path, line):
+    """Record the number of lines of a dump already imported"""
+    c['Comment']['ImportCheckpoint'].replace_one({
+        'path' : os.path.abspath(path)
+    }, {
+        'path' : os.path.abspath(path),
+        'line' : line
+    }, upsert=True)
+
+
+def comments(lines, source=None):
+    """
+    Translate and tokenize lines of a dump into Comments. Records that are
+    not valid JSON, or have no valid date, are skipped and counted, and
+    records of deleted authors are left out. If source is None, each
+    record's subreddit is used. Returns the comments and the number of
+    records skipped.
+    """
+    result = []
+    skipped = 0
+    for line in lines:
+        try:
+            data = json.loads(line)
+            response = reddit.Response(data, source or data.get('subreddit'))
+        except (ValueError, KeyError, TypeError, AttributeError, OverflowError):
+            skipped += 1
+            continue
+        if response['author'] and response['author'] != '[deleted]':
+            result.append(objects.Comment(response.translation))
+    return result, skipped
+
+
+def translate(lines, source=None):
+    """Translate and tokenize lines of a dump, and return the comments as documents, with the number of records skipped"""
+    comment_list, skipped = comments(lines, source)
+    return [comment.__todocument__() for comment in comment_list], skipped
+
+
+def _translate(args):
+    line, lines, source = args
+    return (line,) + translate(lines, source)
+
+
+def chunks(path, start=0, size=CHUNK_SIZE):
+    """Yield (line reached, lines) for each chunk of a dump, skipping the first start lines"""
+    with open_dump(path) as f:
+        line = start
+        f = islice(f, start, None)
+        while True:
+            lines = list(islice(f, size))
+            if not lines:
+                return
+            line += len(lines)
+            yield line, lines
+
+
+def import_dump(path, source=None, processes=None, batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE, sketch=False):
+    """
+    Import every comment of a dump, resuming from its checkpoint, and warn
+    of any records that could not be read. Returns the number of comments
+    inserted.
+
+    source : str
+        Source of every comment. Defaults to the subreddit of each record
+    processes : int
+        Number of worker processes. Defaults to the number of cores
+    """
+    start = get_checkpoint(path)
+    inserted = 0
+    skipped = 0
+    batch = []
+    reached = start
+    with multiprocessing.Pool(processes) as pool:
+        tasks = ((line, lines, source) for line, lines in chunks(path, start, chunk_size))
+        for reached, documents, chunk_skipped in pool.imap(_translate, tasks):
+            skipped += chunk_skipped
+            batch.extend([objects.Comment(document) for document in documents])
+            if len(batch) >= batch_size:
+                inserted += objects.insert_batch(batch, sketch)
+                set_checkpoint(path, reached)
+                batch = []
+        if batch:
+            inserted += objects.insert_batch(batch, sketch)
+        set_checkpoint(path, reached)
+    if skipped:
+        warnings.warn("{} records of {} could not be read, and were skipped".format(skipped, path))
+    return inserted
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='Newline-delimited JSON dump, optionally compressed with gzip, bzip2, or xz')
+    parser.add_argument('--source', default=None, help='Source of every comment. Defaults to the subreddit of each')
+    parser.add_argument('--processes', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Number of comments inserted between checkpoints')
+    args = parser.parse_args()
+
+    print(import_dump(args.path, args.source, args.processes, args.batch_size))
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""
+Concurrent polling of many subreddits, feeding batches of new comments to
+the insert_comments task through a bounded queue.
+
+Each source is polled by its own coroutine, within its own request rate.
+A source whose walk fails is logged and retried after a growing delay,
+while the others keep polling. When the queue is full, pollers wait before
+fetching more, and the queue only drains while few enough dispatched
+batches are unfinished, so that fetching slows down when Celery or MongoDB
+fall behind.
+
+Coroutines use async and await, so this module needs Python 3.5 or later.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+from datetime import datetime
+import logging
+from pkg_resources import require
+from redicorpus import objects
+from redicorpus.get import reddit
+import requests
+import time
+
+# Root of the Reddit JSON API
+BASE_URL = 'https://www.reddit.com'
+
+# Largest number of comments in one listing page
+PAGE_SIZE = 100
+
+# Requests per second, and the burst of requests, allowed for each source
+RATE = 0.5
+BURST = 2
+
+# Seconds between walks of the listing of a source
+POLL_INTERVAL = 30
+
+# Seconds before walking a source again after a failed walk, doubled with
+# each failure in a row up to MAX_BACKOFF
+BACKOFF = 60
+MAX_BACKOFF = 3600
+
+# Largest number of comments waiting to be batched
+QUEUE_SIZE = 10000
+
+# Largest number of dispatched batches that may be unfinished
+MAX_PENDING = 50
+
+logger = logging.getLogger(__name__)
+
+
+class RequestsTransport(object):
+    """
+    Fetches JSON documents with a requests session, in the executor of the
+    event loop. Any object with a coroutine get(url, params) that returns
+    the decoded document can be used in its place.
+    """
+
+    def __init__(self, user_agent=None):
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = user_agent or "redicorpus version {} by /u/MonsieurDufayel".format(require('redicorpus')[0].version)
+
+    async def get(self, url, params=None):
+        """Return decoded JSON document at url"""
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(None, lambda: self.session.get(url, params=params, timeout=30))
+        response.raise_for_status()
+        return response.json()
+
+
+class RateLimit(object):
+    """Token bucket allowing rate requests per second, in bursts of up to burst"""
+
+    def __init__(self, rate=RATE, burst=BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        """Wait until a request is allowed, and use it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Fetcher(object):
+    """
+    Polls a list of subreddits concurrently and inserts their new comments
+
+    transport : object
+        HTTP layer with a coroutine get(url, params). Defaults to a
+        RequestsTransport
+    dispatch : callable
+        Called with each batch of translations, and returns an AsyncResult.
+        Defaults to sending an insert_comments task
+    """
+
+    def __init__(self, sources, transport=None, dispatch=None, base_url=BASE_URL, rate=RATE, burst=BURST, interval=POLL_INTERVAL, queue_size=QUEUE_SIZE, batch_size=reddit.BATCH_SIZE, batch_window=reddit.BATCH_WINDOW, max_pending=MAX_PENDING, backoff=BACKOFF, max_backoff=MAX_BACKOFF):
+        self.sources = list(sources)
+        self.transport = transport or RequestsTransport()
+        self.dispatch = dispatch or (lambda batch: objects.insert_comments.apply_async(args=[batch]))
+        self.base_url = base_url
+        self.limits = dict([(source, RateLimit(rate, burst)) for source in self.sources])
+        self.interval = interval
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.pending = []
+
+    async def __blocking__(self, function, *args):
+        """Run a blocking function in the executor of the event loop"""
+        return await asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+    async def __backpressure__(self):
+        """Wait while too many dispatched batches are unfinished"""
+        while True:
+            self.pending = [result for result in self.pending if not result.ready()]
+            if len(self.pending) < self.max_pending:
+                return
+            await asyncio.sleep(1)
+
+    async def __send__(self, batch):
+        await self.__backpressure__()
+        self.pending.append(await self.__blocking__(self.dispatch, batch))
+
+    async def listing(self, source, after=None):
+        """Return one page of the newest comments of source, and the name of the last one"""
+        await self.limits[source].acquire()
+        params = {'limit' : PAGE_SIZE, 'sort' : 'new'}
+        if after:
+            params['after'] = after
+        document = await self.transport.get('{}/r/{}/comments.json'.format(self.base_url, source), params)
+        return [child['data'] for child in document['data']['children'] if child.get('kind') == 't1'], document['data'].get('after')
+
+    async def walk(self, source, queue):
+        """Put every comment of source newer than its datelimit on queue, and move the datelimit"""
+        datelimit = await self.__blocking__(objects.get_datelimit, source)
+        new_date = datetime.utcnow()
+        after = None
+        while True:
+            page, after = await self.listing(source, after)
+            for data in page:
+                if datetime.utcfromtimestamp(data['created_utc']) <= datelimit:
+                    after = None
+                    break
+                result = reddit.Response(data, source)
+                if result['author']:
+                    await queue.put(result.translation)
+            if not after:
+                break
+        await self.__blocking__(objects.set_datelimit, source, new_date)
+
+    async def poll(self, source, queue, walks=None):
+        """
+        Walk the listing of source every interval seconds, walks times or
+        forever. Failed walks are logged and count as walks, and the next
+        one waits for the backoff, doubled with each failure in a row
+        """
+        failures = 0
+        while walks is None or walks > 0:
+            started = time.monotonic()
+            delay = self.interval
+            try:
+                await self.walk(source, queue)
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                failures += 1
+                delay = max(delay, min(self.max_backoff, self.backoff * 2 ** (failures - 1)))
+                logger.exception("Polling %s failed %d times in a row, retrying in %s seconds", source, failures, delay)
+            if walks is not None:
+                walks -= 1
+            await asyncio.sleep(max(0, delay - (time.monotonic() - started)))
+
+    async def drain(self, queue):
+        """Send comments on queue in batches of batch_size, or after batch_window seconds"""
+        batch = []
+        loop = asyncio.get_event_loop()
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0, deadline - loop.time())
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = None
+            except asyncio.CancelledError:
+                if batch:
+                    await self.__send__(batch)
+                raise
+            if item is not None:
+                if not batch:
+                    deadline = loop.time() + self.batch_window
+                batch.append(item)
+            if batch and (len(batch) >= self.batch_size or loop.time() >= deadline):
+                await self.__send__(batch)
+                batch = []
+                deadline = None
+
+    async def run(self, walks=None):
+        """Poll every source, walks times each or forever, while inserting what is fetched"""
+        queue = asyncio.Queue(self.queue_size)
+        consumer = asyncio.ensure_future(self.drain(queue))
+        try:
+            await asyncio.gather(*[self.poll(source, queue, walks) for source in self.sources])
+            while not queue.empty():
+                await asyncio.sleep(0.1)
+        finally:
+            consumer.cancel()
+            try:
+                await consumer
+            except asyncio.CancelledError:
+                pass
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('sources', nargs='+', help='Subreddit names from which to draw comments')
+    parser.add_argument('--rate', type=float, default=RATE, help='Requests per second for each subreddit')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='Seconds between polls of each subreddit')
+    parser.add_argument('--batch-size', type=int, default=reddit.BATCH_SIZE, help='Largest number of comments inserted by one task')
+    args = parser.parse_args()
+
+    fetcher = Fetcher(args.sources, rate=args.rate, interval=args.interval, batch_size=args.batch_size)
+    asyncio.get_event_loop().run_until_complete(fetcher.run())
@@ -6,6 +6,13 @@ from datetime import datetime, timedelta
 from pkg_resources import require
 import praw
 from redicorpus import objects, tools
+import time
+
+# Largest number of comments sent to a worker as one insert_comments task
+BATCH_SIZE = 100
+
+# Seconds after its first comment that a partial batch is sent anyway
+BATCH_WINDOW = 10
 
 class Client(object):
 
@@ -32,6 +39,23 @@ class Client(object):
                 break
         objects.set_datelimit(self.source, self.new_date)
 
+    def batches(self, size=BATCH_SIZE, window=BATCH_WINDOW):
+        """
+        Group new comments into lists of translations, each sent when it
+        holds size comments or its first comment is window seconds old
+        """
+        batch = []
+        started = time.time()
+        for comment in self.request():
+            if not batch:
+                started = time.time()
+            batch.append(comment.translation)
+            if len(batch) >= size or time.time() - started >= window:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
 class Response(object):
 
     def __init__(self, response, source):
@@ -56,15 +80,15 @@ class Response(object):
 
     def __translate__(self):
         self['_id'] = self.response.get('id')
-        self['url'] = self.response.get('link_url') + self['_id']
+        self['url'] = (self.response.get('link_url') or '') + self['_id']
         self['thread_id'] = self.response.get('link_id')
         self['parent_id'] = self.response.get('parent_id')
         self['raw'] = self.response.get('body')
-        self['date'] = datetime.utcfromtimestamp(self.response['created_utc'])
-        try:
-            self['author'] = self.response.get('author').name
-        except:
-            self['author'] = None
+        # Some dumps hold timestamps as strings
+        self['date'] = datetime.utcfromtimestamp(float(self.response['created_utc']))
+        # praw gives a Redditor object, and the JSON API its name
+        author = self.response.get('author')
+        self['author'] = getattr(author, 'name', author)
         self['controversiality'] = self.response.get('controversiality')
         self['score'] = self.response.get('score')
         try:
@@ -79,8 +103,10 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
     parser.add_argument('source', help='Subreddit name from which to draw comments \nFor all subreddits, use "all"')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='Largest number of comments inserted by one task')
+    parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW, help='Seconds to wait for a batch to fill')
     args = parser.parse_args()
 
     reddit = Client(source=args.source)
-    for comment in reddit.request():
-        objects.insert_comment.apply_async(args=[comment.translation])
+    for batch in reddit.batches(args.batch_size, args.batch_window):
+        objects.insert_comments.apply_async(args=[batch])
@@ -8,52 +8,104 @@ Built on MongoDB, Celery, and NLTK
 
 from __future__ import absolute_import
 
+from array import array
 from arrow import Arrow, utcnow
+from celery import chord
+from collections import Counter
 from copy import deepcopy
 from datetime import datetime, timedelta
-from math import log
-from nltk import ngrams, word_tokenize, pos_tag, SnowballStemmer, WordNetLemmatizer
-from pymongo.errors import DuplicateKeyError
-from pymongo.collection import ReturnDocument
-from redicorpus import c, tools
+import multiprocessing
+import numpy as np
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import redicorpus
+from redicorpus import c, cache, snapshot, text, tools
 from redicorpus import exceptions as e
+from redicorpus.dictionary import DUPLICATE_KEY, TERM_CACHE, find_terms, insert_terms, lookup
+from redicorpus.sketch import HyperLogLog
+from redicorpus.text import Interner
 from redicorpus.celery import app
 import warnings
 
+# Number of comments fetched in each round trip by get_comments
+COMMENT_PAGE_SIZE = 1000
+
+# Number of daily Body records read at a time by build_rollups
+ROLLUP_PAGE_SIZE = 1000
+
 # Count interfaces
 
 class Count(object):
+    """
+    Raw counts of the terms in a vector. Every count type is computed over
+    whole arrays at once.
+
+    counts : ArrayLike
+        Number of occurrences of each term
+    documents : ArrayLike
+        Set of documents containing each term, or the number of them
+    users : ArrayLike
+        Set of users of each term, or the number of them
+    n_documents : int
+        Total number of documents. Required if documents holds numbers
+    n_users : int
+        Total number of users. Required if users holds numbers
+    """
 
-    def __init__(self, counts, documents, users):
+    def __init__(self, counts, documents, users, n_documents=None, n_users=None):
         self.counts = counts
         self.documents = documents
         self.users = users
+        self.n_documents = n_documents
+        self.n_users = n_users
+        self.size = max([len(item) for item in [counts, documents, users]])
 
     def __class__(self):
         return Count
 
+    def __frequency__(self, list_like):
+        """Return numeric array of the number of items in each element"""
+        data = self.__toarray__(list_like)
+        if data.dtype == object:
+            data = np.frompyfunc(self.length, 1, 1)(data).astype(np.int64)
+        return data
+
+    def __toarray__(self, list_like):
+        """Return values as a NumPy array padded to the length of the vector"""
+        if isinstance(list_like, ArrayLike):
+            data = list_like.data
+        else:
+            data = np.asarray(list_like)
+        if len(data) < self.size:
+            padded = np.zeros(self.size, dtype=data.dtype)
+            if data.dtype == object:
+                padded.fill(None)
+            padded[:len(data)] = data
+            data = padded
+        return data
+
     def count_documents(self):
         """Return ArrayLike of number of documents"""
-        return ArrayLike([self.length(item) for item in self.documents])
+        return ArrayLike(self.__frequency__(self.documents))
 
     def count_users(self):
         """Return ArrayLike of number of users"""
-        return ArrayLike([self.length(item) for item in self.users])
+        return ArrayLike(self.__frequency__(self.users))
 
     def get(self):
-        return self.counts.data
+        return self.__toarray__(self.counts)
 
     def inverse_total_counts(self):
         """Return inverse of count total"""
-        return sum(self.counts) ** -1
+        return float(self.__toarray__(self.counts).sum()) ** -1
 
     def inverse_total_documents(self):
         """Return inverse of document total"""
-        return len(self.unique_documents()) ** -1
+        return float(self.total_documents()) ** -1
 
     def inverse_total_users(self):
         """Return inverse of user total"""
-        return len(self.unique_users()) ** -1
+        return float(self.total_users()) ** -1
 
     @staticmethod
     def length(list_like):
@@ -62,15 +114,22 @@ class Count(object):
         except TypeError:
             return 0
 
+    def total_documents(self):
+        """Return number of unique documents"""
+        if self.n_documents is None:
+            self.n_documents = len(self.unique_documents())
+        return self.n_documents
+
+    def total_users(self):
+        """Return number of unique users"""
+        if self.n_users is None:
+            self.n_users = len(self.unique_users())
+        return self.n_users
+
     @staticmethod
     def unique(list_like):
         """Return set of items from a list of sets of items"""
-        total_set = set()
-        for sub_list in list_like:
-            if not sub_list:
-                sub_list = set()
-            total_set = total_set | set(sub_list)
-        return total_set
+        return set().union(*[sub_list for sub_list in list_like if sub_list])
 
     def unique_documents(self):
         """Return set of documents from a list of sets of documents"""
@@ -78,55 +137,42 @@ class Count(object):
 
     def unique_users(self):
         """Return set of users from a list of sets of users"""
-        return self.unique(self.documents)
+        return self.unique(self.users)
 
 
 class Tf(Count):
 
-    def __init__(self, counts, documents, users):
-        super(Tf, self).__init__(counts, documents, users)
-
     def __class__(self):
         return Tf
 
     def get(self):
         """Calculate the proportional frequency of the terms in a vector"""
-        inverse = self.inverse_total_counts()
-        return self.counts * inverse
+        return self.__toarray__(self.counts) * self.inverse_total_counts()
 
 
 class Tfidf(Count):
 
-    def __init__(self, counts, documents, users):
-        super(Tfidf, self).__init__(counts, documents, users)
-        self.tf = Tf
-
-        def __class__(self):
-            return Tfidf
+    def __class__(self):
+        return Tfidf
 
     def get(self):
         """Calculate the tf-idf of the terms in a vector"""
-        tf = ArrayLike(self.tf(self.counts, self.documents, self.users).get())
-        inverse = self.inverse_total_documents()
-        documents = self.count_documents()
-        idf = ArrayLike([ log( (item + 1) * inverse ) for item in documents])
+        tf = self.__toarray__(self.counts) * self.inverse_total_counts()
+        documents = self.__frequency__(self.documents)
+        idf = np.log((documents + 1) * self.inverse_total_documents())
         return tf * idf
 
-class Activation():
 
-    def __init__(self, counts, documents, users):
-        super(Activation, self).__init__(counts, documents, users)
+class Activation(Count):
 
     def __class__(self):
         return Activation
 
-    def activation(users):
+    def get(self):
         """
         Calculate the probability that an individual used the terms in the vector
         """
-        inverse = self.inverse_total_users()
-        users = ArrayLike([Vector.length(item) for item in users])
-        return users * inverse_total_users
+        return self.__frequency__(self.users) * self.inverse_total_users()
 
 
 # String classes
@@ -134,13 +180,15 @@ class Activation():
 class StringLike(object):
     """Acts like a string, but contains metadata"""
 
+    __slots__ = ('_term', '_raw', '_pos')
+
     def __init__(self, data=None, pos=None):
         if data:
             if isinstance(data, str):
                 self.__fromstring__(data, pos)
+                self.term = self.raw
             elif isinstance(data, tuple) | isinstance(data, list):
                 self.__fromtuple__(data)
-        self.term = self.raw
 
     def __add__(self, x):
         return self.term + str(x)
@@ -171,7 +219,7 @@ class StringLike(object):
         self._raw = data
         self._term = None
         if not pos:
-            pos = pos_tag([data])[0][1]
+            pos = text.tag_word(data)
         self._pos = pos
 
     def __fromtuple__(self, data):
@@ -213,6 +261,8 @@ class StringLike(object):
 class String(StringLike):
     """A string with metadata"""
 
+    __slots__ = ()
+
     def __init__(self, data, pos=None):
         super(String, self).__init__(data, pos)
         self.term = self.raw
@@ -220,10 +270,17 @@ class String(StringLike):
     def __class__(self):
         return String
 
+    @staticmethod
+    def transform(data, pos=None):
+        """Return data unmodified"""
+        return data
+
 
 class Stem(StringLike):
     """A snowball stemmed string with metadata"""
 
+    __slots__ = ()
+
     def __init__(self, data, pos=None):
         super(Stem, self).__init__(data, pos)
         if isinstance(data, str):
@@ -234,12 +291,19 @@ class Stem(StringLike):
 
     def stemmer(self, data):
         """Return stemmed data"""
-        return SnowballStemmer('english').stem(data)
+        return self.transform(data)
+
+    @staticmethod
+    def transform(data, pos=None):
+        """Return stemmed data"""
+        return text.stem(data)
 
 
 class Lemma(StringLike):
     """A WordNet lemmatized string with metadata"""
 
+    __slots__ = ()
+
     def __init__(self, data, pos=None):
         super(Lemma, self).__init__(data, pos)
         if isinstance(data, str):
@@ -254,7 +318,12 @@ class Lemma(StringLike):
         pos : str
             Should be one of 'v', 'r', 'a', or 'n'
         """
-        return WordNetLemmatizer().lemmatize(data, tools.pos_to_wordnet(pos))
+        return self.transform(data, pos)
+
+    @staticmethod
+    def transform(data, pos=None):
+        """Return lemmatized data based on part of speech"""
+        return text.lemmatize(data, pos)
 
 
 class Gram(object):
@@ -336,6 +405,132 @@ class Gram(object):
         """Get tuple of terms in gram"""
         return tuple([item.term for item in self.gram])
 
+class TokenStore(object):
+    """
+    Columnar tokens of a single string type, held as parallel arrays of
+    interned term, raw, and part of speech ids. Acts like a list of
+    StringLike objects, which are only built when an item is accessed.
+
+    strings : Interner
+        Table of the ids, which may be shared with the other stores of a
+        comment. Defaults to a new table
+    """
+
+    __slots__ = ('str_type', 'strings', 'terms', 'raws', 'pos')
+
+    def __init__(self, str_type, strings=None):
+        self.str_type = str_type
+        self.strings = strings if strings is not None else Interner()
+        self.terms = array('l')
+        self.raws = array('l')
+        self.pos = array('l')
+
+    def __getitem__(self, ix):
+        if isinstance(ix, slice):
+            return [self[i] for i in range(*ix.indices(len(self)))]
+        return self.str_type(self.__totuple__(ix))
+
+    def __iter__(self):
+        for ix in range(len(self)):
+            yield self[ix]
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __repr__(self):
+        return '{} of {} tokens'.format(self.str_type.__name__, len(self))
+
+    @classmethod
+    def __fromtagged__(cls, str_type, tagged, strings=None):
+        """Make instance from (token, pos) tuples"""
+        store = cls(str_type, strings)
+        for raw, pos in tagged:
+            store.append(str_type.transform(raw, pos), raw, pos)
+        return store
+
+    @classmethod
+    def __fromtuples__(cls, str_type, data, strings=None):
+        """Make instance from (term, raw, pos, str_type) tuples"""
+        store = cls(str_type, strings)
+        for item in data:
+            store.append(item[0], item[1], item[2])
+        return store
+
+    def __totuple__(self, ix):
+        """Get token at ix as a (term, raw, pos, str_type) tuple"""
+        return self.strings[self.terms[ix]], self.strings[self.raws[ix]], self.strings[self.pos[ix]], self.str_type.__name__
+
+    def __totuples__(self):
+        """Convert instance to list of tuples for db compatibility"""
+        return [self.__totuple__(ix) for ix in range(len(self))]
+
+    def append(self, term, raw, pos):
+        """Add a token to the end of the store"""
+        self.terms.append(self.strings.intern(term))
+        self.raws.append(self.strings.intern(raw))
+        self.pos.append(self.strings.intern(pos))
+
+    def grams(self, n):
+        """Yield a GramView for every gram of length n"""
+        for offset in range(len(self) - n + 1):
+            yield GramView(self, offset, n)
+
+
+class GramView(object):
+    """
+    Acts like a Gram, but reads terms from a TokenStore at an offset rather
+    than holding StringLike objects
+    """
+
+    __slots__ = ('store', 'offset', 'n')
+
+    def __init__(self, store, offset, n):
+        self.store = store
+        self.offset = offset
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __str__(self):
+        return ' '.join(self.term)
+
+    def __column__(self, column):
+        return tuple([self.store.strings[ix] for ix in column[self.offset:self.offset + self.n]])
+
+    def __todb__(self):
+        """Convert instance into document for db compatibility"""
+        return {
+        'term' : self.term,
+        'raw' : self.raw,
+        'pos' : self.pos,
+        'str_type' : self.str_type.__name__
+        }
+
+    @property
+    def gram(self):
+        """Get tuple of StringLike objects"""
+        return tuple(self.store[self.offset:self.offset + self.n])
+
+    @property
+    def pos(self):
+        """Get tuple of parts of speech"""
+        return self.__column__(self.store.pos)
+
+    @property
+    def raw(self):
+        return self.__column__(self.store.raws)
+
+    @property
+    def str_type(self):
+        """Get string class of terms in gram"""
+        return self.store.str_type
+
+    @property
+    def term(self):
+        """Get tuple of terms in gram"""
+        return self.__column__(self.store.terms)
+
 # Dict classes
 
 class DictLike(object):
@@ -438,8 +633,7 @@ class Comment(DictLike):
                 self.__fromdocument__(data)
             else:
                 self.__fromdict__(data)
-        for str_type in self.str_classes:
-            self[str_type.__name__] = [str_type(token, pos) for token, pos in pos_tag(word_tokenize(self['cooked'].lower()))]
+                self.__tokenize__()
 
     def __class__(self):
         return Comment
@@ -448,83 +642,194 @@ class Comment(DictLike):
         """Make instance from database document"""
         str_type_list = StringLike.__subclasses__()
         key_list = [subclass.__name__ for subclass in str_type_list]
+        strings = Interner()
         for subclass, key in zip(str_type_list, key_list):
-            self.data[key] = [subclass(tuple(item)) for item in data[key]]
+            self.data[key] = TokenStore.__fromtuples__(subclass, data[key], strings)
         for key in data:
             if key not in key_list:
                 self.data[key] = data.get(key)
 
-    def __updatebody__(self, gram):
+    def __tokenize__(self):
+        """Tokenize and tag cooked text once, and derive every string type from it"""
+        tagged = text.tokenize(self['cooked'])
+        strings = Interner()
+        for str_type in self.str_classes:
+            self[str_type.__name__] = TokenStore.__fromtagged__(str_type, tagged, strings)
+
+    def __updatebody__(self, gram, sketch=False):
         """Pre-calculate and cache intermediate corpus data"""
-        collection = c['Body'][self['source']]
-        round_date = Arrow(self['date'].year, self['date'].month, self['date'].day).datetime
-        collection.update_one(
-            {
-            'date' : round_date,
-            'term' : gram.term,
-            'raw' : gram.raw,
-            'pos' : gram.pos,
-            'n' : len(gram),
-            'str_type' : gram.str_type.__name__
-            }, {
+        for period, collection, round_date in self.__bodyperiods__():
+            collection.update_one(
+                {
+                'date' : round_date,
+                'term' : gram.term,
+                'raw' : gram.raw,
+                'pos' : gram.pos,
+                'n' : len(gram),
+                'str_type' : gram.str_type.__name__
+                }, self.__bodyupdate__(1, sketch, period),
+                upsert=True)
+
+    def __updatedictionary__(self, gram):
+        """Create dictionary entries for any new grams"""
+        str_type = gram.str_type.__name__
+        if lookup(str_type, len(gram), gram.term) is None:
+            insert_terms(str_type, len(gram), [gram.term])
+
+    def __aggregategrams__(self):
+        """
+        Collapse the grams of every string type and length into unique keys
+        of (str_type, n, term, raw, pos), with the number of times each
+        occurs in the instance
+        """
+        result = Counter()
+        for n in self.n_list:
+            for str_type in self.str_classes:
+                for gram in self[str_type.__name__].grams(n):
+                    result[(gram.str_type.__name__, n, gram.term, gram.raw, gram.pos)] += 1
+        return result
+
+    def __aggregateneighbours__(self):
+        """
+        Count, for every gram, the grams of the same string type and length
+        found at each position within COOCCURRENCE_WINDOW of it. Keys are
+        (str_type, n, term, position, neighbour)
+        """
+        result = Counter()
+        window = redicorpus.COOCCURRENCE_WINDOW
+        for n in self.n_list:
+            for str_type in self.str_classes:
+                terms = [gram.term for gram in self[str_type.__name__].grams(n)]
+                for i, term in enumerate(terms):
+                    for j in range(max(0, i - window), min(len(terms), i + window + 1)):
+                        if j != i:
+                            result[(str_type.__name__, n, term, j - i, terms[j])] += 1
+        return result
+
+    def __bodyperiods__(self):
+        """Return (period, collection, date) of the Body record for each period kept"""
+        return [(period, body_collection(self['source'], period), tools.round_date(self['date'], period)) for period in ['day'] + list(redicorpus.ROLLUP_LIST)]
+
+    def __bodyupdate__(self, count=1, sketch=False, period='day'):
+        """
+        Return the update that adds count occurrences of a gram to its Body
+        record. If sketch is set, users and documents are added to
+        HyperLogLog sketches instead of sets. Weekly and monthly records
+        always hold sketches, as sets of a whole week or month would outgrow
+        the document size limit, while hourly sets are no larger than daily
+        ones. Polarity, controversiality, and emotion are only kept in daily
+        records.
+        """
+        update = {
             '$inc' : {
-                'count' : 1, 'total' : 1
-            },
-            '$addToSet' : {
+                'count' : count, 'total' : count
+            }
+        }
+        if period == 'day':
+            update['$push'] = {
+                'polarity' : {'$each' : [self['polarity']] * count},
+                'controversiality' : {'$each' : [self['controversiality']] * count},
+                'emotion' : {'$each' : [self['emotion']] * count}
+            }
+        if sketch or period not in ['day', 'hour']:
+            update['$max'] = HyperLogLog.update('user_sketch', self['user'])
+            update['$max'].update(HyperLogLog.update('document_sketch', self['_id']))
+        else:
+            update['$addToSet'] = {
                 'users' : self['user'],
                 'documents' : self['_id']
-            },
-            '$push' : {
-                'polarity' : self['polarity'],
-                'controversiality' : self['controversiality'],
-                'emotion' : self['emotion']
             }
-            },
-            upsert=True)
+        return update
+
+    def __bulkupdatebody__(self, grams, sketch=False):
+        """Pre-calculate and cache intermediate corpus data in one batch per period"""
+        for period, collection, round_date in self.__bodyperiods__():
+            requests = []
+            for (str_type, n, term, raw, pos), count in grams.items():
+                requests.append(UpdateOne(
+                    {
+                    'date' : round_date,
+                    'term' : term,
+                    'raw' : raw,
+                    'pos' : pos,
+                    'n' : n,
+                    'str_type' : str_type
+                    }, self.__bodyupdate__(count, sketch, period),
+                    upsert=True))
+            if requests:
+                collection.bulk_write(requests, ordered=False)
 
-    def __updatedictionary__(self, gram):
-        """Create dictionary entries for any new grams"""
-        dictionary = c['Dictionary'][gram.str_type.__name__]
-        counters = c['Counter'][gram.str_type.__name__]
-        term = gram.term
-        n = len(gram)
-        if not dictionary.find_one({'term' : term, 'n' : n}):
-            id_counter = counters.find_one_and_update({
-            'n' : n,
-            },
-            {
-            '$inc' : {
-                'counter' : 1
-                }
-            }, return_document=ReturnDocument.AFTER)
-            dictionary.insert_one({
-            'ix' : id_counter['counter'],
-            'term' : term,
-            'n' : n
-            })
+    @staticmethod
+    def __bulkupdatedictionary__(grams):
+        """Create dictionary entries for any new grams in one batch per string type"""
+        terms = {}
+        for str_type, n, term, _, _ in grams:
+            terms.setdefault((str_type, n), set()).add(term)
+        for (str_type, n), term_set in terms.items():
+            term_set = set([term for term in term_set if TERM_CACHE.get(str_type, n, term) is None])
+            if not term_set:
+                continue
+            for term, ix in find_terms(str_type, n, term_set).items():
+                term_set.discard(term)
+                TERM_CACHE.set(str_type, n, term, ix)
+            if term_set:
+                insert_terms(str_type, n, term_set)
+
+    def __updateneighbours__(self):
+        """
+        Add neighbour counts of every gram to the day's Cooccurrence records
+        in one batch, and the comment to the day's Coverage record
+        """
+        if not redicorpus.COOCCURRENCE_WINDOW:
+            return
+        date = tools.round_date(self['date'], 'day')
+        requests = neighbour_requests(Counter(dict([((date,) + key, count) for key, count in self.__aggregateneighbours__().items()])))
+        if requests:
+            c['Cooccurrence'][self['source']].bulk_write(requests, ordered=False)
+        c['Coverage'][self['source']].bulk_write(coverage_requests(Counter([date]), redicorpus.COOCCURRENCE_WINDOW), ordered=False)
+
+    def __todocument__(self):
+        """Convert instance into document for db compatibility"""
+        key_list = [str_type.__name__ for str_type in self.str_classes]
+        document = deepcopy(dict([(key, value) for key, value in self.data.items() if key not in key_list]))
+        for key in key_list:
+            document[key] = self[key].__totuples__()
+        return document
 
     def __updatecomment__(self):
         """Insert instance into database"""
-        collection = c['Comment'][self['source']]
-        document = deepcopy(self.data)
-        for str_type in self.str_classes:
-            document[str_type.__name__] = [string_like.__totuple__() for string_like in self[str_type.__name__]]
-        return collection.insert_one(document)
+        return c['Comment'][self['source']].insert_one(self.__todocument__())
 
-    def insert(self):
-        """Perform all necessary database updates for instance"""
+    def insert(self, bulk=False, sketch=False):
+        """
+        Perform all necessary database updates for instance
+
+        bulk : bool
+            Collapse repeated grams in memory and send dictionary and body
+            updates as unordered batches, instead of one round trip per gram
+        sketch : bool
+            Record users and documents of each gram in fixed-size HyperLogLog
+            sketches, instead of sets that grow with every comment
+        """
         success = False
         try:
             success = self.__updatecomment__()
         except DuplicateKeyError:
             warnings.warn("Not Implemented : id={} already in collection".format(self['_id']))
         if success:
-            for n in self.n_list:
-                for str_type in self.str_classes:
-                    for item in ngrams(self[str_type.__name__], n):
-                        gram = Gram(item)
-                        self.__updatedictionary__(gram)
-                        self.__updatebody__(gram)
+            self.__updateneighbours__()
+            if bulk:
+                grams = self.__aggregategrams__()
+                self.__bulkupdatedictionary__(grams)
+                self.__bulkupdatebody__(grams, sketch)
+            else:
+                for n in self.n_list:
+                    for str_type in self.str_classes:
+                        for gram in self[str_type.__name__].grams(n):
+                            self.__updatedictionary__(gram)
+                            self.__updatebody__(gram, sketch)
+            cache.invalidate(self['source'], self['date'])
+            snapshot.touch(self['source'], self['date'])
             return success
 
 # Array classes
@@ -532,13 +837,15 @@ class Comment(DictLike):
 class ArrayLike(object):
     """
     Acts like an array, but supports both list-like and dict-like index methods.
+
+    Values are held in a NumPy array. If sparse is set, only values that
+    differ from null are held, in a dict of index to value.
     """
 
-    def __init__(self, data=None, n=1, str_type=String, null=0):
-        self.data = []
+    def __init__(self, data=None, n=1, str_type=String, null=0, sparse=False):
         self.null = null
-        if data:
-            self.data = data
+        self.sparse = sparse
+        self.data = data if data is not None else []
         self.n = n
         if str_type not in StringLike.__subclasses__():
             raise ValueError("{} is not a valid string type class".format(str_type))
@@ -549,15 +856,9 @@ class ArrayLike(object):
         """
         Update values of array in place and return. Supports length coersion for ArrayLike and broadcasting for ints or floats
         """
-        if isinstance(other, int) | isinstance(other, float):
-            self.data = [item + other for item in self.data]
-            return self.data
-        elif isinstance(other, ArrayLike):
-            self.__matchlen__(other)
-            result = []
-            for i in range(0, len(self.data)):
-                result.append(self.data[i] + other.data[i])
-            return result
+        if isinstance(other, (int, float, np.number)):
+            return self.__scalar__(np.add, other)
+        return self.__elementwise__(np.add, other)
 
     def __class__(self):
         return ArrayLike
@@ -569,10 +870,37 @@ class ArrayLike(object):
         else:
             return True
 
+    def __elementwise__(self, ufunc, other):
+        """Return new ArrayLike from applying ufunc to self and another array"""
+        if not isinstance(other, ArrayLike):
+            other = ArrayLike(other, self.n, self.str_type, self.null)
+        self.__matchlen__(other)
+        return ArrayLike(ufunc(self.data, other.data), self.n, self.str_type, self.null, self.sparse and other.sparse)
+
+    def __eq__(self, other):
+        if isinstance(other, ArrayLike):
+            other = other.data
+        other = np.asarray(other)
+        return other.shape == (len(self),) and bool(np.all(self.data == other))
+
     def __forcelen__(self, length):
         """Increase length of array by adding self.null items"""
-        if length > len(self):
-            self.data = self.data + [self.null] * (length - len(self))
+        if length <= self.length:
+            return
+        if not self.sparse and length > len(self._data):
+            capacity = max(length, 2 * len(self._data))
+            data = self.__full__(capacity, self._data.dtype)
+            data[:self.length] = self._data[:self.length]
+            self._data = data
+        self.length = length
+
+    def __full__(self, length, dtype=None):
+        """Return array of self.null items"""
+        if dtype is None:
+            dtype = self.dtype
+        data = np.empty(length, dtype=dtype)
+        data.fill(self.null)
+        return data
 
     def __getitem__(self, key):
         """
@@ -580,11 +908,13 @@ class ArrayLike(object):
         key : int, str
             Either the integer index of the item, or the term that is wanted
         """
-        if isinstance(key, int):
+        if isinstance(key, (int, np.integer)):
             ix = key
         else:
             ix = self.__getix__(key)
-        if ix:
+        if ix is not None:
+            if self.sparse:
+                return self._values.get(ix, self.null)
             try:
                 return self.data[ix]
             except IndexError:
@@ -608,65 +938,74 @@ class ArrayLike(object):
                 key = [item.term for item in key]
         else:
             raise TypeError("Expected StringLike, or tuple of StringLikes")
-        try:
-            ix = self.dictionary.find_one(
-            {
-                'term' : key,
-                'n' : self.n
-            })['ix']
-        except TypeError:
-            ix = None
-        return ix
+        return lookup(self.str_type.__name__, self.n, key)
+
+    def __iadd__(self, other):
+        """Add to values of array in place"""
+        self.data = self.__add__(other).data
+        return self
+
+    def __imul__(self, other):
+        """Multiply values of array in place"""
+        self.data = self.__mul__(other).data
+        return self
 
     def __iter__(self):
         for item in self.data:
             yield item
 
     def __len__(self):
-        return len(self.data)
+        return self.length
 
     def __matchlen__(self, other):
         """
         Match lengths of two ArrayLikes by padding the shorter one with self.null
         """
         if len(self) > len(other):
-            other.data = other.data + [self.null] * (len(self) - len(other))
-        elif len(other) > len(self.data):
-            self.data = self.data + [self.null] * (len(other) - len(self.data))
+            other.__forcelen__(len(self))
+        elif len(other) > len(self):
+            self.__forcelen__(len(other))
 
     def __mul__(self, other):
         """
         Update values of array in place and return. Supports length coersion for ArrayLike and broadcasting for ints or floats
         """
-        if isinstance(other, float) | isinstance(other, int):
-            self.data = [item * other for item in self.data]
-            return self.data
-        elif isinstance(other, ArrayLike):
-            self.__matchlen__(other)
-            result = []
-            for i in range(0, len(self.data)):
-                result.append(self.data[i] * other.data[i])
-            return result
+        if isinstance(other, (int, float, np.number)):
+            return self.__scalar__(np.multiply, other)
+        return self.__elementwise__(np.multiply, other)
 
     def __repr__(self):
-        return '{} of length {}'.format(self.__class__(), len(self.data))
+        return '{} of length {}'.format(self.__class__(), len(self))
+
+    def __scalar__(self, ufunc, other):
+        """Apply ufunc with a scalar to every value in place, and return self"""
+        if self.sparse:
+            keys = list(self._values.keys())
+            values = ufunc(np.array(list(self._values.values())), other)
+            self._values = dict(zip(keys, values.tolist()))
+            self.null = ufunc(self.null, other).item()
+        else:
+            self.data = ufunc(self.data, other)
+        return self
 
     def __setbyix__(self, key, value):
         """
         Set value by index. Supports setting values beyond the length of the data.
         """
-        try:
-            self.data[key] = value
-        except IndexError as e:
-            if e.args[0] == 'list assignment index out of range':
-                self.__forcelen__(key + 1)
-                self.data[key] = value
+        if key >= self.length:
+            self.__forcelen__(key + 1)
+        if self.sparse:
+            self._values[key] = value
+        else:
+            if self._data.dtype != object and np.result_type(self._data.dtype, type(value)) != self._data.dtype:
+                self._data = self._data.astype(np.result_type(self._data.dtype, type(value)))
+            self._data[key] = value
 
     def __setitem__(self, key, value):
         """
         Set value by index or key. Supports setting values beyond the length of the data.
         """
-        if isinstance(key, int):
+        if isinstance(key, (int, np.integer)):
             self.__setbyix__(key, value)
         else:
             ix = self.__getix__(key)
@@ -676,7 +1015,46 @@ class ArrayLike(object):
                 raise ValueError("Term not in dictionary")
 
     def __str__(self):
-        return str(self.data)
+        return str(self.tolist())
+
+    @property
+    def data(self):
+        """Get values as a NumPy array"""
+        if self.sparse:
+            data = self.__full__(self.length)
+            for ix, value in self._values.items():
+                data[ix] = value
+            return data
+        return self._data[:self.length]
+
+    @data.setter
+    def data(self, value):
+        if isinstance(value, ArrayLike):
+            value = value.data
+        if self.dtype == object:
+            data = np.empty(len(value), dtype=object)
+            data[:] = list(value)
+        elif len(value):
+            data = np.array(value)
+        else:
+            data = self.__full__(0)
+        self.length = len(data)
+        if self.sparse:
+            ix = np.flatnonzero(data != self.null)
+            self._values = dict(zip(ix.tolist(), data[ix].tolist()))
+        else:
+            self._data = data
+
+    @property
+    def dtype(self):
+        """Get NumPy type matching self.null"""
+        if isinstance(self.null, (int, float, np.number)):
+            return np.asarray(self.null).dtype
+        return object
+
+    def tolist(self):
+        """Return values as a list, for db compatibility"""
+        return self.data.tolist()
 
 
 class Vector(ArrayLike):
@@ -692,9 +1070,50 @@ class Vector(ArrayLike):
         Class of string data
     count_type : Count
         Class of language data
+
+    The following are optional:
+    sketch : bool
+        Estimate document and user frequencies from the HyperLogLog sketches
+        written by Comment.insert(sketch=True). Only sketch vectors read the
+        weekly and monthly Body records, while every vector reads hourly
+        records if 'hour' is in ROLLUP_LIST
+    aggregate : bool
+        Sum Body records by term in a MongoDB aggregation pipeline, and fetch
+        only the totals for each term. With sketch, records are instead read
+        without their other fields, and sketches merged as they are read.
+        Without sketch, users are counted once per run of whole days or hours
+        and once per partial hour or day at either end.
+    workers : int
+        Split the range into this many chunks of whole days, and count each
+        in a separate process. Partial counts are merged with their sets of
+        documents and users, so results match those of a single process.
+    snapshot : bool
+        Memory-map the values from a snapshot file if there is one and no
+        comments were inserted into its range since, and write one after
+        computing them if the range is over.
+
+    Counts, and the numbers of documents and users of each term, are cached
+    in BodyCache, separately for each sketch and aggregate mode. A vector
+    whose range starts where a cached one does, and stops later, extends the
+    cached counts with those of the rest of its range. Users of extended
+    ranges are counted once per extension, so extended entries are flagged,
+    and Activation vectors are only read from entries counted over exactly
+    their range.
     """
 
-    def __init__(self, source, n, str_type, count_type, start_date=Arrow(1970,1,1).datetime, stop_date=utcnow().datetime):
+    def __init__(self, source, n, str_type, count_type, start_date=Arrow(1970,1,1).datetime, stop_date=utcnow().datetime, sketch=False, aggregate=False, workers=1, snapshot=False):
+        self.__setup__(source, n, str_type, count_type, start_date, stop_date, sketch, aggregate, workers)
+        if not snapshot:
+            self.__fromdb__()
+            return
+        try:
+            self.__fromsnapshot__()
+        except e.DocumentNotFound:
+            self.__fromdb__()
+            self.__tosnapshot__()
+
+    def __setup__(self, source, n, str_type, count_type, start_date, stop_date, sketch=False, aggregate=False, workers=1):
+        """Check arguments and set attributes, without counting"""
         super(Vector, self).__init__(n=n, str_type=str_type)
         if source not in c['Comment'].collection_names():
             raise ValueError("{} is not a collection in the Comment database".format(source))
@@ -705,71 +1124,283 @@ class Vector(ArrayLike):
                 raise TypeError("{} is not a datetime.datetime object".format(date))
 
         self.count_type = count_type
+        self.sketch = sketch
+        self.aggregate = aggregate
+        self.workers = workers
         self.start_date = Arrow.fromdatetime(start_date).datetime
         self.stop_date = Arrow.fromdatetime(stop_date).datetime
+        self.source = source
         self.body = c['Body'][source]
         self.cache = c['BodyCache'][source]
         self.comment = c['Comment'][source]
-        self.__fromdb__()
+
+    @classmethod
+    def __fromresults__(cls, results, *args, **kwargs):
+        """
+        Make instance from the unmerged results of counting chunks of its
+        range, and cache its counts. Other arguments are those of Vector.
+        """
+        vector = cls.__new__(cls)
+        vector.__setup__(*args, **kwargs)
+        vector.__newresult__()
+        for result in results:
+            vector.__mergeresult__(result)
+        state = vector.__state__()
+        vector.__tocache__(state)
+        vector.data = vector.count_type(**state).get()
+        return vector
 
     def __fromdb__(self):
-        """Try fetching vector from cache, then build from comment data"""
+        """
+        Try fetching counts from cache, extend them with comment data up to
+        the stop date, and compute the count type
+        """
         try:
-            self.__fromcache__()
+            _id, stop_date, state, extended = self.__fromcache__()
         except e.DocumentNotFound:
-            self.__fromcursor__()
+            _id, stop_date, state, extended = None, self.start_date, None, False
+        if state is None or stop_date < self.stop_date:
+            delta = self.__fromcursor__(stop_date, self.stop_date)
+            if state:
+                state = self.__merge__(state, delta)
+                extended = True
+            else:
+                state = delta
+            self.__tocache__(state, _id, extended)
+        self.data = self.count_type(**state).get()
+
+    def __fromsnapshot__(self):
+        """
+        Memory-map values from the snapshot of the vector, without copying
+        them. The generation of the range is read first, for the snapshot
+        written if there is none
+        """
+        self.generation = snapshot.generation(self.source, self.start_date, self.stop_date)
+        self._data = snapshot.load(self.source, self.n, self.str_type, self.count_type, self.start_date, self.stop_date, self.sketch, self.aggregate)
+        self.length = len(self._data)
+
+    def __tosnapshot__(self):
+        """Write values to a snapshot file, if the range of the vector is over"""
+        return snapshot.save(self, self.generation)
 
     def __fromcache__(self):
-        """Fetch vector from cache"""
-        result = self.cache.find_one({
+        """
+        Fetch the cached counts with the same start date and the latest stop
+        date that is not after that of the vector. Returns _id, stop date,
+        counts of the cached range, and whether they were extended.
+        """
+        query = {
             'n' : self.n,
+            'str_type' : self.str_type.__name__,
+            'sketch' : self.sketch,
+            'aggregate' : self.aggregate,
             'start_date' : self.start_date,
-            'stop_date' : self.stop_date,
-            self.count_type.__name__ : {
-                '$exists' : True
-            }
-        }, {
-            self.count_type.__name__ : 1
-        })
+            'stop_date' : {'$lte' : self.stop_date}
+        }
+        if self.count_type is Activation:
+            query['stop_date'] = self.stop_date
+            query['extended'] = False
+        result = self.cache.find_one(query, sort=[('stop_date', DESCENDING)])
         if result:
-            self.data = result[self.count_type.__name__]
+            cache.hit(self.cache, result['_id'])
+            state = dict([(key, result[key]) for key in ['n_documents', 'n_users']])
+            for key in ['counts', 'documents', 'users']:
+                state[key] = ArrayLike(result[key], self.n, self.str_type)
+            return result['_id'], Arrow.fromdatetime(result['stop_date']).datetime, state, result.get('extended', False)
         else:
+            cache.miss(self.cache)
             raise e.DocumentNotFound(self.n, 'date range')
 
-    def __frombody__(self, start_date, stop_date):
-        for document in self.body.find({
+    def __merge__(self, state, other):
+        """Return the sum of the counts of two adjoining ranges"""
+        result = {}
+        for key in ['counts', 'documents', 'users']:
+            result[key] = state[key] + other[key]
+        for key in ['n_documents', 'n_users']:
+            result[key] = state[key] + other[key]
+        return result
+
+    def __state__(self):
+        """Return the result as counts, and numbers of documents and users"""
+        count = Count(**self.__counts__())
+        return {
+            'counts' : ArrayLike(count.get(), self.n, self.str_type),
+            'documents' : count.count_documents(),
+            'users' : count.count_users(),
+            'n_documents' : int(count.total_documents()),
+            'n_users' : int(count.total_users())
+        }
+
+    def __accumulate__(self, ix, count, documents, users):
+        """
+        Add count, and the documents and users of a term, to the result.
+        documents and users are iterables, HyperLogLogs in sketch mode, or
+        numbers in aggregate mode.
+        """
+        self.result['counts'][ix] += count
+        if self.sketch:
+            for key, value in [('documents', documents), ('users', users)]:
+                sketch = self.result[key][ix]
+                if sketch is None:
+                    self.result[key][ix] = sketch = HyperLogLog()
+                sketch.merge(value)
+        elif self.aggregate:
+            self.result['documents'][ix] += documents
+            self.result['users'][ix] += users
+        else:
+            self.result['documents'][ix] = self.result['documents'][ix] | set(documents)
+            self.result['users'][ix] = self.result['users'][ix] | set(users)
+
+    def __counts__(self):
+        """Return the arguments of count_type for the result"""
+        if not self.sketch:
+            return self.result
+        kwargs = {'counts' : self.result['counts']}
+        for key, total in [('documents', 'n_documents'), ('users', 'n_users')]:
+            sketch_list = self.result[key].data
+            kwargs[key] = ArrayLike([len(sketch) if sketch else 0 for sketch in sketch_list], self.n, self.str_type)
+            kwargs[total] = len(HyperLogLog.union(sketch_list))
+        return kwargs
+
+    def __fromaggregate__(self, start_date, stop_date, period='day'):
+        """Sum Body records for each term on the server, and add the totals"""
+        match = {
+            '$match' : {
+                'date' : {
+                    '$gte' : start_date, '$lt' : stop_date
+                },
+                'n' : self.n,
+                'str_type' : self.str_type.__name__
+            }
+        }
+        str_type = self.str_type.__name__
+        body = body_collection(self.source, period)
+        if self.sketch:
+            # Sketches are merged on the client as records are read, as
+            # pushing every sketch of a term into one group outgrows the
+            # document size limit over long ranges, and MongoDB 3.0 cannot
+            # unwind the registers of a sketch. Only the fields summed are
+            # fetched
+            for document in body.find(match['$match'], {
+                'term' : 1, 'count' : 1, 'document_sketch' : 1, 'user_sketch' : 1
+            }, no_cursor_timeout=True):
+                self.__accumulate__(self.result['counts'].__getix__(document['term']), document['count'],
+                    HyperLogLog.__fromdb__(document.get('document_sketch')),
+                    HyperLogLog.__fromdb__(document.get('user_sketch')))
+            return
+        # Sets are unioned by unwinding them and grouping twice, rather than
+        # with $reduce, which needs MongoDB 3.4
+        totals = {}
+        for document in body.aggregate([match, {
+            '$group' : {'_id' : '$term', 'count' : {'$sum' : '$count'}}
+        }], allowDiskUse=True):
+            totals[tuple(document['_id'])] = {'count' : document['count'], 'documents' : 0, 'users' : 0}
+        for key in ['documents', 'users']:
+            for document in body.aggregate([match,
+                {'$unwind' : '$' + key},
+                {'$group' : {'_id' : {'term' : '$term', 'item' : '$' + key}}},
+                {'$group' : {'_id' : '$_id.term', 'total' : {'$sum' : 1}}}
+            ], allowDiskUse=True):
+                totals[tuple(document['_id'])][key] = document['total']
+        for term, total in totals.items():
+            self.__accumulate__(lookup(str_type, self.n, term), total['count'], total['documents'], total['users'])
+        for key in ['documents', 'users']:
+            for document in body.aggregate([match,
+                {'$unwind' : '$' + key},
+                {'$group' : {'_id' : '$' + key}},
+                {'$group' : {'_id' : None, 'total' : {'$sum' : 1}}}
+            ], allowDiskUse=True):
+                self.result['n_' + key] += document['total']
+
+    def __frombody__(self, start_date, stop_date, period='day'):
+        if self.aggregate:
+            return self.__fromaggregate__(start_date, stop_date, period)
+        for document in body_collection(self.source, period).find({
             'date' : {
-                '$gte' : self.start_date, '$lt' : self.stop_date
+                '$gte' : start_date, '$lt' : stop_date
             },
             'n' : self.n,
             'str_type' : self.str_type.__name__
         }, no_cursor_timeout=True):
             ix = self.result['counts'].__getix__(document['term'])
-            self.result['counts'][ix] += document['count']
-            self.result['documents'][ix] = self.result['documents'][ix] | set(document['documents'])
-            self.result['users'][ix] = self.result['users'][ix] | set(document['users'])
-
-    def __fromcursor__(self):
-        # Initialize data structure
+            if self.sketch:
+                self.__accumulate__(ix, document['count'],
+                    HyperLogLog.__fromdb__(document.get('document_sketch')),
+                    HyperLogLog.__fromdb__(document.get('user_sketch')))
+            else:
+                self.__accumulate__(ix, document['count'], document['documents'], document['users'])
+
+    def __fromcursor__(self, start_date, stop_date):
+        """Count terms between two dates, and return them as a state"""
+        chunks = tools.chunk_time(start_date, stop_date, self.workers)
+        if self.workers > 1 and len(chunks) > 1:
+            self.__newresult__()
+            # Worker processes are spawned rather than forked, as MongoClient
+            # is not fork-safe, and are given the connection and settings of
+            # this process
+            with multiprocessing.get_context('spawn').Pool(len(chunks), initializer=redicorpus.init_worker, initargs=(redicorpus.worker_settings(),)) as pool:
+                for result in pool.starmap(count_range, [
+                    (self.source, self.n, self.str_type, self.sketch, self.aggregate, start, stop) for start, stop in chunks
+                ]):
+                    self.__mergeresult__(result)
+        else:
+            self.__countrange__(start_date, stop_date)
+        return self.__state__()
+
+    def __newresult__(self):
+        """Initialize empty counts, documents, and users"""
+        if self.sketch:
+            null = None
+        elif self.aggregate:
+            null = 0
+        else:
+            null = set()
         self.result = {
         'counts' : ArrayLike(n=self.n, str_type=self.str_type),
-        'documents' : ArrayLike(n=self.n, str_type=self.str_type, null=set()),
-        'users' : ArrayLike(n=self.n, str_type=self.str_type, null=set())
+        'documents' : ArrayLike(n=self.n, str_type=self.str_type, null=null),
+        'users' : ArrayLike(n=self.n, str_type=self.str_type, null=null)
         }
-        split = tools.split_time(self.start_date, self.stop_date)
-        if split['n_days']:
-            self.__frombody__(split['start_day'], split['stop_day'])
+        if self.aggregate and not self.sketch:
+            self.result['n_documents'] = 0
+            self.result['n_users'] = 0
+
+    def __countrange__(self, start_date, stop_date):
+        """Count terms between two dates into a new result"""
+        self.__newresult__()
+        # Weekly and monthly records only hold sketches, so other vectors
+        # are counted from daily and hourly records
+        periods = redicorpus.ROLLUP_LIST if self.sketch else [period for period in redicorpus.ROLLUP_LIST if period == 'hour']
+        split = tools.split_time(start_date, stop_date, periods)
+        self.__frombuckets__(split['buckets'])
         if split['remainder_start']:
-            self.__fromcomment__(self.start_date, split['start_day'])
+            self.__fromcomment__(start_date, split['start_edge'])
         if split['remainder_stop']:
-            self.__fromcomment__(split['stop_day'], self.stop_date)
-        # Get appropriate count type result
-        self.data = self.count_type(**self.result).get()
-        self.__tocache__()
+            self.__fromcomment__(split['stop_edge'], stop_date)
+
+    def __mergeresult__(self, other):
+        """Add the result of counting another range, as returned by count_range, to the result"""
+        for ix, count in enumerate(other['counts']):
+            if count:
+                self.__accumulate__(ix, count, other['documents'][ix], other['users'][ix])
+        for key in ['n_documents', 'n_users']:
+            if key in other:
+                self.result[key] += other[key]
+
+    def __frombuckets__(self, buckets):
+        """Build vector from Body records of (period, start, stop) buckets"""
+        ranges = []
+        for period, start_date, stop_date in buckets:
+            if ranges and ranges[-1][0] == period and ranges[-1][2] == start_date:
+                ranges[-1][2] = stop_date
+            else:
+                ranges.append([period, start_date, stop_date])
+        for period, start_date, stop_date in ranges:
+            self.__frombody__(start_date, stop_date, period)
 
     def __fromcomment__(self, start_date, stop_date):
         """Build vector from comment database"""
         str_type = self.str_type.__name__
+        user_set = set()
         for document in self.comment.find(
             {
                 'date' : {
@@ -781,111 +1412,229 @@ class Vector(ArrayLike):
                 '_id' : 1
             }, no_cursor_timeout=True
         ):
-            gram_list = [
-                Gram(item) for item in ngrams([
-                        self.str_type(item) for item in document[str_type]
-                    ], self.n)
-            ]
-            for gram in gram_list:
-                ix = self.result['counts'].__getix__(gram.term)
-                self.result['counts'][ix] += 1
-                self.result['documents'][ix] = self.result['documents'][ix] | set(document['_id'])
-                self.result['users'][ix] = self.result['documents'][ix] | set(document['user'])
-
-    def __tocache__(self):
-        """Insert vector into cache"""
-        self.cache.update_one({
+            store = TokenStore.__fromtuples__(self.str_type, document[str_type])
+            documents, users = [document['_id']], [document['user']]
+            if self.sketch:
+                documents, users = HyperLogLog(documents), HyperLogLog(users)
+            elif self.aggregate:
+                documents, users = 1, 1
+                self.result['n_documents'] += 1
+                user_set.add(document['user'])
+            counts = Counter([self.result['counts'].__getix__(gram.term) for gram in store.grams(self.n)])
+            for ix, count in counts.items():
+                self.__accumulate__(ix, count, documents, users)
+        if self.aggregate and not self.sketch:
+            self.result['n_users'] += len(user_set)
+
+    def __tocache__(self, state, _id=None, extended=False):
+        """
+        Insert counts into cache, replacing the cached range they extend.
+        extended marks counts summed from more than one range
+        """
+        document = {
+            'n' : self.n,
+            'str_type' : self.str_type.__name__,
+            'sketch' : self.sketch,
+            'aggregate' : self.aggregate,
+            'extended' : extended,
             'start_date' : self.start_date,
-            'stop_date' : self.stop_date
-        }, {
-            '$set' : {self.count_type.__name__ : self.data}
-        }, upsert=True)
+            'stop_date' : self.stop_date,
+            'counts' : state['counts'].tolist(),
+            'documents' : state['documents'].tolist(),
+            'users' : state['users'].tolist(),
+            'n_documents' : state['n_documents'],
+            'n_users' : state['n_users']
+        }
+        cache.prepare(document)
+        if _id is None:
+            cache.store(self.cache, document, dict([(key, document[key]) for key in ['n', 'str_type', 'sketch', 'aggregate', 'start_date', 'stop_date']]))
+        else:
+            cache.store(self.cache, document, {'_id' : _id}, upsert=False)
+        cache.evict(self.cache)
 
 
 class Map(ArrayLike):
-    """Conditional probability map for a single term"""
+    """
+    Conditional probability map for a single term
+
+    position : int
+        Offset of the neighbouring grams mapped, or 0 for every gram near
+        the term. Within COOCCURRENCE_WINDOW, every occurrence of the term
+        is counted, where 0 means every gram within the window, and whole
+        days whose comments all had their neighbour counts kept at insert
+        are summed from those counts, while the rest of the range is counted
+        from the comments themselves. Beyond it, maps are counted from the
+        first occurrence of the term in each comment, where 0 means every
+        other gram in the comment. The window is kept with cached maps.
+    """
 
     def __init__(self, gram, source, position=0, start_date=Arrow(1970,1,1).datetime, stop_date=utcnow().datetime):
-        super(Map, self).__init__()
-        if isinstance(gram, Gram):
-            self.str_type = gram.str_type
-            self.term = gram.term
-            self.n = len(gram)
-        elif isinstance(gram, StringLike):
+        self.__setup__(gram, source, position, start_date, stop_date)
+        self.__fromdb__()
+
+    def __setup__(self, gram, source, position, start_date, stop_date):
+        """Check arguments and set attributes, without counting"""
+        if isinstance(gram, StringLike):
             gram = Gram(gram)
-            self.str_type = gram.str_type
-            self.term = gram.term
-            self.n = len(gram)
-        else:
-            raise TypeError("{} must be StringLike or Gram".format(self.term))
+        elif not isinstance(gram, Gram):
+            raise TypeError("{} must be StringLike or Gram".format(gram))
+        self.__setterm__(gram.str_type, gram.term, source, position, start_date, stop_date, map_window(position))
+
+    def __setterm__(self, str_type, term, source, position, start_date, stop_date, window):
+        """
+        Set attributes for a tuple of terms of str_type, without counting.
+        window is that of map_window
+        """
+        super(Map, self).__init__(str_type=str_type)
+        self.term = tuple(term)
+        self.n = len(self.term)
         if source not in c['Comment'].collection_names():
-            raise ValueError("{} is not a collection in Comment")
-        self.dictionary = c['Dictionary'][self.str_type.__name__]
+            raise ValueError("{} is not a collection in Comment".format(source))
 
         self.start_date = start_date
         self.stop_date = stop_date
         self.position = position
+        self.window = window
         self.source = source
 
-        self.__fromdb__()
+    @classmethod
+    def __fromresults__(cls, results, *args):
+        """
+        Make instance from the neighbour counts of chunks of its range, and
+        cache it. Other arguments are those of __setterm__.
+        """
+        mapping = cls.__new__(cls)
+        mapping.__setterm__(*args)
+        counts = Counter()
+        for result in results:
+            counts.update(result)
+        mapping.__fromcounts__(counts)
+        return mapping
 
     def __fromdb__(self):
         try:
             self.__fromcollection__()
         except e.DocumentNotFound:
-            self.__fromcursor__()
+            self.__fromcounts__(count_map(self.source, self.str_type, self.term, self.position, self.window, self.start_date, self.stop_date))
 
     def __fromcollection__(self):
-        try:
-            self.data = c['Map'][self.source].find_one({
-                'term' : self.term,
-                'position' : self.position,
-                'start_date' : self.start_date,
-                'stop_date' : self.stop_date
-            })['probabilities']
-        except TypeError:
+        collection = c['Map'][self.source]
+        document = collection.find_one({
+            'term' : self.term,
+            'position' : self.position,
+            'window' : self.window,
+            'start_date' : self.start_date,
+            'stop_date' : self.stop_date
+        })
+        if document:
+            cache.hit(collection, document['_id'])
+            self.data = document['probabilities']
+        else:
+            cache.miss(collection)
             raise e.DocumentNotFound(self.term, 'daterange')
 
-    def __fromcursor__(self):
+    def __fromcounts__(self, counts):
+        """Set probabilities from a dict of neighbouring term to count, and cache them"""
         self.data = []
-        for document in c['Body'][self.source].find({
-            'term' : self.term,
-            'date' : {'$gt' : self.start_date, '$lt' : self.stop_date},
-            'str_type' : self.str_type.__name__,
-            'n' : self.n
-        }, {
-        'documents' : 1
-        }, no_cursor_timeout=True):
-            for _id in document['documents']:
-                comment = get_comment(_id, self.source)
-                gram_list = []
-                for ngram in ngrams(comment[self.str_type.__name__], self.n):
-                    gram_list.append(Gram(ngram).term)
-                if self.position:
-                    loc = gram_list.index(self.term) + position
-                    self[gram_list[loc]] + 1
-                else:
-                    gram_list.remove(self.term)
-                    for gram in gram_list:
-                        self[gram] += 1
-        try:
-            self * (sum(self) ** -1)
-        except ZeroDivisionError:
+        for term, count in counts.items():
+            ix = lookup(self.str_type.__name__, self.n, term)
+            if ix is not None:
+                self[ix] += count
+        total = float(sum(self))
+        if not total:
             raise ValueError("No comments with term {} found".format(self.term))
+        self * (total ** -1)
         self.__tocollection__()
 
     def __tocollection__(self):
-        c['Body'][self.source].insert_one({
+        collection = c['Map'][self.source]
+        cache.store(collection, cache.prepare({
         'term' : self.term,
         'position' : self.position,
+        'window' : self.window,
         'start_date' : self.start_date,
         'stop_date' : self.stop_date,
-        'probabilities' : self.data,
-        })
+        'probabilities' : self.tolist(),
+        }))
+        cache.evict(collection)
 
 
 # Module functions
 
+def body_collection(source, period='day'):
+    """Return the Body collection of source for period"""
+    if period == 'day':
+        return c['Body'][source]
+    return c['Body' + period.title()][source]
+
+def build_rollups(source, period, start_date, stop_date, page_size=ROLLUP_PAGE_SIZE):
+    """
+    Rebuild the Body records of a rollup period from the daily records, for
+    every period between two datetimes. Users and documents of the daily
+    records, whether sets or sketches, are unioned into sketches, reading
+    about page_size daily records at a time
+    """
+    if period == 'hour':
+        raise ValueError("Hourly records can only be written when comments are inserted")
+    date = tools.round_date(start_date, period)
+    collection = body_collection(source, period)
+    collection.create_indexes([
+        IndexModel(
+            [('n', ASCENDING), ('date', DESCENDING)], unique=False, background=True
+        )
+    ])
+    while date < stop_date:
+        stop = tools.next_date(date, period)
+        page = []
+        size = 0
+        for group in c['Body'][source].aggregate([{
+            '$match' : {'date' : {'$gte' : date, '$lt' : stop}}
+        }, {
+            '$group' : {
+                '_id' : {
+                    'term' : '$term', 'raw' : '$raw', 'pos' : '$pos', 'n' : '$n', 'str_type' : '$str_type'
+                },
+                'count' : {'$sum' : '$count'},
+                'total' : {'$sum' : '$total'},
+                'records' : {'$push' : '$_id'}
+            }
+        }], allowDiskUse=True):
+            page.append(group)
+            size += len(group['records'])
+            if size >= page_size:
+                collection.bulk_write(rollup_requests(source, date, page), ordered=False)
+                page = []
+                size = 0
+        if page:
+            collection.bulk_write(rollup_requests(source, date, page), ordered=False)
+        date = stop
+
+def rollup_requests(source, date, group_list):
+    """
+    Return the replacements of the rollup records starting at date, from
+    groups of daily Body records with their summed counts and _ids
+    """
+    daily = {}
+    for document in c['Body'][source].find({
+        '_id' : {'$in' : [_id for group in group_list for _id in group['records']]}
+    }, {
+        'documents' : 1, 'users' : 1, 'document_sketch' : 1, 'user_sketch' : 1
+    }):
+        daily[document['_id']] = document
+    requests = []
+    for group in group_list:
+        record = dict(group['_id'], date=date, count=group['count'], total=group['total'])
+        for key, field in [('documents', 'document_sketch'), ('users', 'user_sketch')]:
+            sketch = HyperLogLog()
+            for _id in group['records']:
+                document = daily.get(_id, {})
+                sketch.merge(HyperLogLog.__fromdb__(document.get(field)))
+                for item in document.get(key) or []:
+                    sketch.add(item)
+            record[field] = sketch.__todb__()
+        requests.append(ReplaceOne(dict(group['_id'], date=date), record, upsert=True))
+    return requests
+
 def get_comment(_id, source):
     """Retrieve comment from db"""
     document = c['Comment'][source].find_one({'_id' : _id})
@@ -894,17 +1643,360 @@ def get_comment(_id, source):
     else:
         raise e.DocumentNotFound(_id, source)
 
+def get_comments(id_list, source, str_type=String, page_size=COMMENT_PAGE_SIZE, start_date=None, stop_date=None):
+    """
+    Yield (_id, TokenStore) for each stored comment in a list of ids,
+    fetching page_size comments per query. Only the tokens of str_type are
+    read, and they are not tokenized or tagged again. Ids not in the
+    database, or not from start_date until stop_date if these are given,
+    are skipped.
+    """
+    collection = c['Comment'][source]
+    id_list = list(id_list)
+    for i in range(0, len(id_list), page_size):
+        query = {'_id' : {'$in' : id_list[i:i + page_size]}}
+        if start_date is not None:
+            query['date'] = {'$gte' : start_date, '$lt' : stop_date}
+        for document in collection.find(query, {
+            str_type.__name__ : 1
+        }):
+            yield document['_id'], TokenStore.__fromtuples__(str_type, document[str_type.__name__])
+
 @app.task
-def insert_comment(response):
+def insert_comment(response, bulk=False, sketch=False):
     """Create comment instance and insert it"""
-    return Comment(response).insert()
+    return Comment(response).insert(bulk=bulk, sketch=sketch)
+
+@app.task
+def insert_comments(response_list, sketch=False):
+    """Create comment instances from a batch of responses and insert them together"""
+    return insert_batch([Comment(response) for response in response_list], sketch)
 
-def get_body(source, n=1, str_type=String, count_type=Count, start_date=utcnow().datetime, stop_date=utcnow().datetime):
-    """Retrieve counts by date and type"""
-    return Vector(source, n, str_type, count_type, start_date, stop_date)
+def insert_batch(comment_list, sketch=False):
+    """
+    Insert a list of comments, combining their Dictionary, Body, and
+    Cooccurrence updates so that each record is written once per batch.
+    Comments already in the database are skipped with a warning. Updates
+    are written before the comments themselves, so that comments of an
+    interrupted batch are counted when it is retried, rather than skipped
+    as duplicates with their updates lost. Returns the number of comments
+    inserted.
+    """
+    by_source = {}
+    for comment in comment_list:
+        by_source.setdefault(comment['source'], []).append(comment)
+    inserted = 0
+    for source, comments in by_source.items():
+        collection = c['Comment'][source]
+        stored = set([document['_id'] for document in collection.find({
+            '_id' : {'$in' : [comment['_id'] for comment in comments]}
+        }, {
+            '_id' : 1
+        })])
+        new = []
+        for comment in comments:
+            if comment['_id'] in stored:
+                warnings.warn("Not Implemented : id={} already in collection".format(comment['_id']))
+            else:
+                stored.add(comment['_id'])
+                new.append(comment)
+        comments = new
+        if not comments:
+            continue
+        grams = Counter()
+        body = {}
+        neighbours = Counter()
+        days = Counter()
+        for comment in comments:
+            comment_grams = comment.__aggregategrams__()
+            grams.update(comment_grams)
+            for period, _, round_date in comment.__bodyperiods__():
+                for key, count in comment_grams.items():
+                    update = comment.__bodyupdate__(count, sketch, period)
+                    body_key = (period, round_date) + key
+                    body[body_key] = merge_update(body[body_key], update) if body_key in body else update
+            if redicorpus.COOCCURRENCE_WINDOW:
+                date = tools.round_date(comment['date'], 'day')
+                days[date] += 1
+                for key, count in comment.__aggregateneighbours__().items():
+                    neighbours[(date,) + key] += count
+        Comment.__bulkupdatedictionary__(grams)
+        requests = {}
+        for (period, date, str_type, n, term, raw, pos), update in body.items():
+            requests.setdefault(period, []).append(UpdateOne(
+                {
+                'date' : date,
+                'term' : term,
+                'raw' : raw,
+                'pos' : pos,
+                'n' : n,
+                'str_type' : str_type
+                }, update,
+                upsert=True))
+        for period, request_list in requests.items():
+            body_collection(source, period).bulk_write(request_list, ordered=False)
+        if neighbours:
+            c['Cooccurrence'][source].bulk_write(neighbour_requests(neighbours), ordered=False)
+        if days:
+            c['Coverage'][source].bulk_write(coverage_requests(days, redicorpus.COOCCURRENCE_WINDOW), ordered=False)
+        failed = set()
+        try:
+            collection.insert_many([comment.__todocument__() for comment in comments], ordered=False)
+        except BulkWriteError as error:
+            for write_error in error.details['writeErrors']:
+                if write_error['code'] != DUPLICATE_KEY:
+                    raise
+                failed.add(write_error['index'])
+                warnings.warn("id={} was inserted by another worker, and counted twice".format(comments[write_error['index']]['_id']))
+        inserted += len(comments) - len(failed)
+        dates = [comment['date'] for comment in comments]
+        cache.invalidate(source, min(dates), max(dates) + timedelta(0, 0, 1))
+        snapshot.touch(source, min(dates), max(dates) + timedelta(0, 0, 1))
+    return inserted
+
+def neighbour_requests(neighbours):
+    """
+    Return the upserts that add neighbour counts to Cooccurrence records,
+    from a Counter keyed on (date, str_type, n, term, position, neighbour)
+    """
+    return [UpdateOne(
+        {
+        'date' : date,
+        'term' : term,
+        'position' : position,
+        'neighbour' : neighbour,
+        'n' : n,
+        'str_type' : str_type
+        }, {
+        '$inc' : {'count' : count}
+        },
+        upsert=True) for (date, str_type, n, term, position, neighbour), count in neighbours.items()]
+
+def merge_update(result, other):
+    """Add a Body, Cooccurrence, or Coverage update to another of the same record, in place, and return it"""
+    for field, value in other.get('$inc', {}).items():
+        result['$inc'][field] = result['$inc'].get(field, 0) + value
+    for field, value in other.get('$push', {}).items():
+        result['$push'][field]['$each'] = result['$push'][field]['$each'] + value['$each']
+    for field, value in other.get('$max', {}).items():
+        result['$max'][field] = max(result['$max'].get(field, 0), value)
+    for field, value in other.get('$min', {}).items():
+        result['$min'][field] = min(result['$min'].get(field, value), value)
+    for field, value in other.get('$addToSet', {}).items():
+        each = result['$addToSet'][field]
+        if not isinstance(each, dict):
+            each = result['$addToSet'][field] = {'$each' : [each]}
+        if isinstance(value, dict):
+            each['$each'].extend(value['$each'])
+        else:
+            each['$each'].append(value)
+    return result
 
-def get_map(gram, source, n, position=0, start_date=Arrow(1970,1,1).datetime, stop_date=utcnow().datetime):
-    """Retrieve pre-computed map"""
+def count_range(source, n, str_type, sketch, aggregate, start_date, stop_date):
+    """
+    Count terms of a source between two dates, and return the unmerged
+    result as plain lists and totals, which can be pickled to and from
+    worker processes
+    """
+    vector = Vector.__new__(Vector)
+    ArrayLike.__init__(vector, n=n, str_type=str_type)
+    vector.source = source
+    vector.sketch = sketch
+    vector.aggregate = aggregate
+    vector.comment = c['Comment'][source]
+    vector.__countrange__(start_date, stop_date)
+    return dict([(key, value.tolist() if isinstance(value, ArrayLike) else value) for key, value in vector.result.items()])
+
+def map_window(position):
+    """
+    Return the window of neighbour counts a Map at position is summed from,
+    or None if it is counted from whole comments
+    """
+    window = redicorpus.COOCCURRENCE_WINDOW
+    if window and abs(position) <= window:
+        return window
+    return None
+
+def coverage_requests(days, window):
+    """
+    Return the upserts that add to the number of comments of each day whose
+    neighbours were counted within window, from a Counter of day to comments
+    """
+    return [UpdateOne({
+        '_id' : day
+        }, {
+        '$inc' : {'comments' : count},
+        '$min' : {'window' : window}
+        }, upsert=True) for day, count in days.items()]
+
+def neighbour_days(source, start_date, stop_date, window):
+    """
+    Return the whole days between two dates whose comments all had their
+    neighbours counted at insert within at least window positions, as a
+    list of (start, stop) runs of consecutive days
+    """
+    day = tools.round_date(start_date)
+    if day < start_date:
+        day = tools.next_date(day)
+    if tools.next_date(day) > stop_date:
+        return []
+    counted = {}
+    for document in c['Coverage'][source].find({
+        '_id' : {'$gte' : day, '$lt' : stop_date},
+        'window' : {'$gte' : window}
+    }):
+        counted[document['_id']] = document['comments']
+    comments = c['Comment'][source]
+    runs = []
+    while tools.next_date(day) <= stop_date:
+        stop = tools.next_date(day)
+        count = counted.get(day.replace(tzinfo=None))
+        if count and count == comments.count({'date' : {'$gte' : day, '$lt' : stop}}):
+            if runs and runs[-1][1] == day:
+                runs[-1] = (runs[-1][0], stop)
+            else:
+                runs.append((day, stop))
+        day = stop
+    return runs
+
+def count_neighbours(source, str_type, term, position, window, start_date, stop_date):
+    """
+    Sum the neighbour counts kept at insert for a term between two whole
+    days, and return them as a Counter of neighbouring term to count
+    """
+    query = {
+        'term' : list(term),
+        'date' : {'$gte' : start_date, '$lt' : stop_date},
+        'str_type' : str_type.__name__,
+        'n' : len(term)
+    }
+    if position:
+        query['position'] = position
+    else:
+        query['position'] = {'$gte' : -window, '$lte' : window}
+    return Counter(dict([(tuple(document['_id']), document['count']) for document in c['Cooccurrence'][source].aggregate([
+        {'$match' : query},
+        {'$group' : {'_id' : '$neighbour', 'count' : {'$sum' : '$count'}}}
+    ], allowDiskUse=True)]))
+
+def count_comments(source, str_type, term, position, window, start_date, stop_date):
+    """
+    Count the neighbours of a term in the comments holding it between two
+    dates, and return them as a Counter of neighbouring term to count. With
+    a window, every occurrence is counted, as at insert, and position 0
+    means every gram within the window. Without, only the first occurrence
+    in each comment is, and position 0 means every other gram.
+    """
+    term = tuple(term)
+    counts = Counter()
+    id_set = set()
+    for document in c['Body'][source].find({
+        'term' : list(term),
+        'date' : {'$gte' : tools.round_date(start_date), '$lt' : stop_date},
+        'str_type' : str_type.__name__,
+        'n' : len(term)
+    }, {
+    'documents' : 1
+    }, no_cursor_timeout=True):
+        id_set.update(document.get('documents', []))
+    for _id, store in get_comments(id_set, source, str_type, start_date=start_date, stop_date=stop_date):
+        gram_list = [gram.term for gram in store.grams(len(term))]
+        if term not in gram_list:
+            continue
+        if window is None:
+            if position:
+                loc = gram_list.index(term) + position
+                if 0 <= loc < len(gram_list):
+                    counts[gram_list[loc]] += 1
+            else:
+                gram_list.remove(term)
+                counts.update(gram_list)
+            continue
+        offsets = [position] if position else [offset for offset in range(-window, window + 1) if offset]
+        for i, gram in enumerate(gram_list):
+            if gram == term:
+                for offset in offsets:
+                    if 0 <= i + offset < len(gram_list):
+                        counts[gram_list[i + offset]] += 1
+    return counts
+
+def count_map(source, str_type, term, position, window, start_date, stop_date):
+    """
+    Count the neighbours of a term between two dates, and return them as a
+    dict of neighbouring term to count. With a window, runs of whole days
+    from neighbour_days are summed from Cooccurrence records, and the rest
+    of the range is counted from comments.
+    """
+    counts = Counter()
+    uncovered = [(start_date, stop_date)]
+    if window is not None:
+        uncovered = []
+        date = start_date
+        for start, stop in neighbour_days(source, start_date, stop_date, abs(position) or window):
+            if date < start:
+                uncovered.append((date, start))
+            counts.update(count_neighbours(source, str_type, term, position, window, start, stop))
+            date = stop
+        if date < stop_date:
+            uncovered.append((date, stop_date))
+    for start, stop in uncovered:
+        counts.update(count_comments(source, str_type, term, position, window, start, stop))
+    return dict(counts)
+
+
+@app.task
+def count_body_shard(source, n, str_type, sketch, aggregate, start_date, stop_date):
+    """Count terms of one shard of the range of a distributed Vector"""
+    return count_range(source, n, str_type, sketch, aggregate, start_date, stop_date)
+
+@app.task
+def merge_body_shards(results, source, n, str_type, count_type, start_date, stop_date, sketch=False, aggregate=False):
+    """Merge the counts of every shard of a distributed Vector, cache them, and return its values as a list"""
+    return Vector.__fromresults__(results, source, n, str_type, count_type, start_date, stop_date, sketch, aggregate).tolist()
+
+@app.task
+def count_map_shard(source, str_type, term, position, window, start_date, stop_date):
+    """Count neighbours of one shard of the range of a distributed Map"""
+    return count_map(source, str_type, term, position, window, start_date, stop_date)
+
+@app.task
+def merge_map_shards(results, str_type, term, source, position, window, start_date, stop_date):
+    """Merge the neighbour counts of every shard of a distributed Map, cache it, and return its probabilities as a list"""
+    return Map.__fromresults__(results, str_type, term, source, position, start_date, stop_date, window).tolist()
+
+def get_body(source, n=1, str_type=String, count_type=Count, start_date=utcnow().datetime, stop_date=utcnow().datetime, sketch=False, aggregate=False, workers=1, asynchronous=False, snapshot=False):
+    """
+    Retrieve counts by date and type
+
+    asynchronous : bool
+        Count workers shards of the range as Celery tasks, merged and cached
+        by a chord callback, and return its AsyncResult rather than the
+        Vector. The result is the list of values of the Vector. The cache is
+        written, but not read.
+    """
+    if asynchronous:
+        return chord([count_body_shard.s(source, n, str_type, sketch, aggregate, start, stop) for start, stop in tools.chunk_time(start_date, stop_date, workers)])(
+            merge_body_shards.s(source, n, str_type, count_type, start_date, stop_date, sketch, aggregate))
+    return Vector(source, n, str_type, count_type, start_date, stop_date, sketch, aggregate, workers, snapshot)
+
+def get_map(gram, source, n, position=0, start_date=Arrow(1970,1,1).datetime, stop_date=utcnow().datetime, workers=1, asynchronous=False):
+    """
+    Retrieve pre-computed map
+
+    asynchronous : bool
+        Count neighbours of workers shards of the range as Celery tasks,
+        merged and cached by a chord callback, and return its AsyncResult
+        rather than the Map. The result is the list of probabilities of the
+        Map. The cache is written, but not read.
+    """
+    if asynchronous:
+        if isinstance(gram, StringLike):
+            gram = Gram(gram)
+        # The window of this process is passed on, so that every shard is
+        # counted with it
+        window = map_window(position)
+        return chord([count_map_shard.s(source, gram.str_type, gram.term, position, window, start, stop) for start, stop in tools.chunk_time(start_date, stop_date, workers)])(
+            merge_map_shards.s(gram.str_type, gram.term, source, position, window, start_date, stop_date))
     return Map(gram, source, position, start_date, stop_date)
 
 def get_datelimit(source):
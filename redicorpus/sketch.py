@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Fixed-size, mergeable cardinality sketches
+"""
+
+from __future__ import absolute_import
+
+from hashlib import sha1
+import numpy as np
+
+# Number of bits of each hash used to choose a register
+PRECISION = 12
+
+
+class HyperLogLog(object):
+    """
+    Estimates the number of distinct items added to it, in 2 ** p registers.
+
+    In the database, a sketch is a sub-document of register number to rank
+    holding only the registers that are set, so that adding an item is a
+    single $max on one field.
+    """
+
+    def __init__(self, items=(), p=PRECISION):
+        self.p = p
+        self.m = 2 ** p
+        self.registers = np.zeros(self.m, dtype=np.uint8)
+        for item in items:
+            self.add(item)
+
+    def __len__(self):
+        return int(round(self.estimate()))
+
+    def __or__(self, other):
+        result = HyperLogLog(p=self.p)
+        result.registers = np.maximum(self.registers, other.registers)
+        return result
+
+    def __repr__(self):
+        return 'HyperLogLog of about {} items'.format(len(self))
+
+    @classmethod
+    def __fromdb__(cls, document, p=PRECISION):
+        """Make instance from database representation"""
+        sketch = cls(p=p)
+        if document:
+            for register, rank in document.items():
+                sketch.registers[int(register)] = rank
+        return sketch
+
+    def __todb__(self):
+        """Convert instance into document for db compatibility"""
+        return {str(register) : int(self.registers[register]) for register in np.flatnonzero(self.registers)}
+
+    @staticmethod
+    def position(item, p=PRECISION):
+        """Return the register and rank of an item for a sketch of precision p"""
+        value = int.from_bytes(sha1(str(item).encode('utf-8')).digest()[:8], 'big')
+        register = value >> (64 - p)
+        remainder = value & ((1 << (64 - p)) - 1)
+        rank = (64 - p) - remainder.bit_length() + 1
+        return register, rank
+
+    @classmethod
+    def update(cls, field, item, p=PRECISION):
+        """Return the $max update that adds item to a sketch stored in field"""
+        register, rank = cls.position(item, p)
+        return {'{}.{}'.format(field, register) : rank}
+
+    def add(self, item):
+        """Add an item to the sketch"""
+        register, rank = self.position(item, self.p)
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def estimate(self):
+        """Return estimated number of distinct items"""
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(2.0 ** -self.registers.astype(float))
+        zeros = int(np.sum(self.registers == 0))
+        if estimate <= 2.5 * self.m and zeros:
+            estimate = self.m * np.log(float(self.m) / zeros)
+        return float(estimate)
+
+    def merge(self, other):
+        """Add every item of another sketch to this one, in place"""
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    @classmethod
+    def union(cls, sketch_list, p=PRECISION):
+        """Return a sketch of the items in any of a list of sketches"""
+        result = cls(p=p)
+        for sketch in sketch_list:
+            if sketch is not None:
+                result.merge(sketch)
+        return result
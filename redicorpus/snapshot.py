@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+On-disk snapshots of computed vectors, read by memory-mapping rather than
+deserializing, so that query processes on a host share one copy of each in
+the page cache.
+
+A snapshot is a flat file of a small header followed by raw arrays:
+
+    magic string, 8 bytes
+    length of the JSON header, as a little-endian unsigned 32-bit integer
+    JSON header, with the key of the snapshot, and the offset, dtype, and
+    length of each array
+    arrays, each starting at a multiple of ALIGNMENT bytes
+
+Snapshots are only written for ranges that ended before the current day,
+as comments are still being inserted into the current one. As comments may
+be inserted on any host, older ones by backfills, staleness is kept in the
+Snapshot database rather than by removing files. Each day of a source has
+a generation, incremented by each insert of comments on that day, so that
+writers to different days do not contend for one document. A snapshot holds
+the sum of the generations of the days in its range from before it was
+computed, and is only loaded while that sum is unchanged.
+"""
+
+from __future__ import absolute_import
+
+from datetime import datetime
+import json
+import numpy as np
+import os
+from pymongo import UpdateOne
+from redicorpus import c, tools
+from redicorpus import exceptions as e
+import struct
+import tempfile
+
+# Directory holding a subdirectory of snapshots for each source
+SNAPSHOT_DIR = os.environ.get('REDICORPUS_SNAPSHOT_DIR', os.path.join(os.path.expanduser('~'), '.redicorpus', 'snapshots'))
+
+MAGIC = b'RCVSNAP1'
+
+# Values start at a multiple of this many bytes from the start of the file
+ALIGNMENT = 64
+
+DATE_FORMAT = '%Y%m%dT%H%M%S'
+
+
+def key(source, n, str_type, count_type, start_date, stop_date, sketch=False, aggregate=False):
+    """Return header fields identifying a vector"""
+    return {
+        'source' : source,
+        'n' : n,
+        'str_type' : str_type.__name__,
+        'count_type' : count_type.__name__,
+        'start_date' : start_date.strftime(DATE_FORMAT),
+        'stop_date' : stop_date.strftime(DATE_FORMAT),
+        'sketch' : bool(sketch),
+        'aggregate' : bool(aggregate)
+    }
+
+
+def path_of(fields, directory=None):
+    """Return path of the snapshot with the given key"""
+    mode = 'sketch' if fields['sketch'] else 'aggregate' if fields['aggregate'] else 'set'
+    name = '{n}-{str_type}-{count_type}-{mode}-{start_date}-{stop_date}.vec'.format(mode=mode, **fields)
+    return os.path.join(directory or SNAPSHOT_DIR, fields['source'], name)
+
+
+def write_file(path, fields, arrays, magic=MAGIC):
+    """
+    Write a list of (name, array) to a snapshot at path, replacing any
+    snapshot already there
+    """
+    layout = {}
+    offset = 0
+    for name, array in arrays:
+        offset += -offset % ALIGNMENT
+        layout[name] = {'offset' : offset, 'dtype' : array.dtype.str, 'length' : len(array)}
+        offset += array.nbytes
+    header = json.dumps(dict(fields, arrays=layout)).encode('utf-8')
+    start = len(magic) + 4 + len(header)
+    start += -start % ALIGNMENT
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Writing to a temporary file and renaming it means readers never map a
+    # partly written snapshot
+    f = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        with f:
+            f.write(magic)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for name, array in arrays:
+                f.write(b'\0' * (start + layout[name]['offset'] - f.tell()))
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(f.name, path)
+    except:
+        os.remove(f.name)
+        raise
+
+
+def read_file(path, magic=MAGIC):
+    """
+    Memory-map the arrays of the snapshot at path, and return its header and
+    a dict of name to array. Arrays are copy-on-write: pages are shared
+    until written to.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError("{} is not a snapshot of this kind".format(path))
+            size, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(size).decode('utf-8'))
+    except FileNotFoundError:
+        raise e.DocumentNotFound(path, 'snapshots')
+    start = len(magic) + 4 + size
+    start += -start % ALIGNMENT
+    arrays = {}
+    for name, layout in header['arrays'].items():
+        dtype = np.dtype(layout['dtype'])
+        if layout['length']:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=start + layout['offset'], shape=(layout['length'],))
+        else:
+            arrays[name] = np.empty(0, dtype=dtype)
+    return header, arrays
+
+
+def write(path, values, fields):
+    """Write values of a vector to a snapshot at path"""
+    values = np.asarray(values)
+    if values.dtype == object:
+        raise TypeError("Only numeric vectors can be written to snapshots")
+    write_file(path, fields, [('values', values)])
+
+
+def read(path):
+    """Memory-map the values of the vector snapshot at path, and return them with its header"""
+    header, arrays = read_file(path)
+    return arrays['values'], header
+
+
+def generation(source, start_date, stop_date):
+    """Return the number of times comments were inserted into source on the days from start_date until stop_date"""
+    for document in c['Snapshot'][source].aggregate([
+        {'$match' : {'_id' : {
+            '$gte' : tools.round_date(start_date.replace(tzinfo=None)),
+            '$lt' : stop_date.replace(tzinfo=None)
+        }}},
+        {'$group' : {'_id' : None, 'generation' : {'$sum' : '$generation'}}}
+    ]):
+        return document['generation']
+    return 0
+
+
+def touch(source, start_date, stop_date=None):
+    """
+    Record that comments of source were inserted on the days from start_date
+    until stop_date, or on the day of start_date, so that snapshots written
+    before and overlapping them are not loaded. Call it once the updates of
+    the comments are written.
+    """
+    date = tools.round_date(start_date.replace(tzinfo=None))
+    stop_date = tools.next_date(date) if stop_date is None else stop_date.replace(tzinfo=None)
+    requests = []
+    while date < stop_date:
+        requests.append(UpdateOne({'_id' : date}, {'$inc' : {'generation' : 1}}, upsert=True))
+        date = tools.next_date(date)
+    c['Snapshot'][source].bulk_write(requests, ordered=False)
+
+
+def is_current(header):
+    """Return whether no comments were inserted into the range of a snapshot since its generation"""
+    start_date = datetime.strptime(header['start_date'], DATE_FORMAT)
+    stop_date = datetime.strptime(header['stop_date'], DATE_FORMAT)
+    return generation(header['source'], start_date, stop_date) <= header.get('generation', 0)
+
+
+def save(vector, generation=0, directory=None):
+    """
+    Write a snapshot of a vector, if its range is over, with the generation
+    of its range read before it was computed. Returns whether it was written
+    """
+    if vector.stop_date.replace(tzinfo=None) > tools.round_date(datetime.utcnow()):
+        return False
+    fields = key(vector.source, vector.n, vector.str_type, vector.count_type, vector.start_date, vector.stop_date, vector.sketch, vector.aggregate)
+    write(path_of(fields, directory), vector.data, dict(fields, generation=generation))
+    return True
+
+
+def load(*args, **kwargs):
+    """
+    Memory-map the values of a vector from its snapshot, unless comments
+    were inserted into its range since. Arguments are those of key, and an
+    optional directory.
+    """
+    directory = kwargs.pop('directory', None)
+    path = path_of(key(*args, **kwargs), directory)
+    values, header = read(path)
+    if not is_current(header):
+        raise e.DocumentNotFound(path, 'snapshots')
+    return values
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Process-wide NLTK models, and memoized token transforms built on them.
+
+Stemmer, lemmatizer, and tagger are expensive to construct, so each is
+built once per process on first use. Token vocabularies are Zipfian, so
+per-token results are cached as well.
+"""
+
+from __future__ import absolute_import
+
+from functools import lru_cache
+from nltk import SnowballStemmer, WordNetLemmatizer, word_tokenize
+from nltk.tag.perceptron import PerceptronTagger
+from redicorpus import tools
+
+# Maximum number of results memoized by each token transform
+TRANSFORM_CACHE_SIZE = 2 ** 16
+
+_models = {}
+
+
+class Interner(object):
+    """
+    Table of strings and small integer ids, shared by the token stores of a
+    comment so that they hold each distinct string once. Tables are not
+    shared between comments, so that they are freed with them
+    """
+
+    __slots__ = ('ids', 'strings')
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __getitem__(self, ix):
+        return self.strings[ix]
+
+    def __len__(self):
+        return len(self.strings)
+
+    def intern(self, string):
+        """Return id of string, adding it to the table if new"""
+        try:
+            return self.ids[string]
+        except KeyError:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            return self.ids[string]
+
+
+def get_stemmer():
+    """Return the process-wide snowball stemmer"""
+    if 'stemmer' not in _models:
+        _models['stemmer'] = SnowballStemmer('english')
+    return _models['stemmer']
+
+
+def get_lemmatizer():
+    """Return the process-wide WordNet lemmatizer"""
+    if 'lemmatizer' not in _models:
+        _models['lemmatizer'] = WordNetLemmatizer()
+    return _models['lemmatizer']
+
+
+def get_tagger():
+    """Return the process-wide part of speech tagger"""
+    if 'tagger' not in _models:
+        _models['tagger'] = PerceptronTagger()
+    return _models['tagger']
+
+
+def tag(tokens):
+    """Return list of (token, pos) tuples for a sequence of tokens"""
+    return get_tagger().tag(list(tokens))
+
+
+def tokenize(string):
+    """Return list of (token, pos) tuples for lowercased text"""
+    return tag(word_tokenize(string.lower()))
+
+
+@lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def tag_word(token):
+    """Return the part of speech of a single token tagged on its own"""
+    return tag([token])[0][1]
+
+
+@lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def stem(token):
+    """Return stemmed token"""
+    return get_stemmer().stem(token)
+
+
+def lemmatize(token, pos=None):
+    """
+    Return lemmatized token based on part of speech
+    pos : str
+        NLTK-style part of speech tag
+    """
+    return _lemmatize(token, tools.pos_to_wordnet(pos))
+
+
+@lru_cache(maxsize=TRANSFORM_CACHE_SIZE)
+def _lemmatize(token, wordnet_pos):
+    return get_lemmatizer().lemmatize(token, wordnet_pos)
+
+
+def cache_info():
+    """Return hit and miss counts for each memoized transform"""
+    return {
+        'tag_word' : tag_word.cache_info(),
+        'stem' : stem.cache_info(),
+        'lemmatize' : _lemmatize.cache_info()
+    }
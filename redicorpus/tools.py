@@ -25,9 +25,77 @@ def pos_to_wordnet(pos):
     else:
         return 'n'
 
-def split_time(start_date, stop_date):
+def round_date(date, period='day'):
     """
-    Split start and stop datetime objects into a period of whole days, and the remainder on either end, and return it as a dictionary
+    Return the start of the period containing date
+    period : str
+        One of 'hour', 'day', 'week' (starting on Monday), or 'month'
+    """
+    date = date.replace(minute=0, second=0, microsecond=0)
+    if period == 'hour':
+        return date
+    date = date.replace(hour=0)
+    if period == 'day':
+        return date
+    elif period == 'week':
+        return date - timedelta(date.weekday())
+    elif period == 'month':
+        return date.replace(day=1)
+    raise ValueError("{} is not a valid period".format(period))
+
+def next_date(date, period='day'):
+    """Return the start of the period after the one starting at date"""
+    if period == 'hour':
+        return date + timedelta(0, 3600)
+    elif period == 'day':
+        return date + timedelta(1)
+    elif period == 'week':
+        return date + timedelta(7)
+    elif period == 'month':
+        return (date.replace(day=28) + timedelta(4)).replace(day=1)
+    raise ValueError("{} is not a valid period".format(period))
+
+def cover_time(start_date, stop_date, periods=('day',)):
+    """
+    Cover the time between start and stop datetime objects with the coarsest periods that fit, and return them as a list of (period, start, stop) tuples in date order. Covering stops at the first date that is not the start of any period
+    periods : iterable
+        Periods that may be used, from 'hour', 'day', 'week', and 'month'
+    """
+    periods = sorted(set(periods) | set(['day']), key=['month', 'week', 'day', 'hour'].index)
+    result = []
+    date = start_date
+    while date < stop_date:
+        for period in periods:
+            stop = next_date(date, period)
+            if round_date(date, period) == date and stop <= stop_date:
+                result.append((period, date, stop))
+                date = stop
+                break
+        else:
+            break
+    return result
+
+def chunk_time(start_date, stop_date, chunks):
+    """
+    Split the time between start and stop datetime objects into at most chunks contiguous (start, stop) tuples of about equal length, and return them as a list in date order. Edges between chunks are whole days, and the last chunk takes any remainder
+    """
+    days = (round_date(stop_date) - round_date(start_date)).days
+    step = timedelta(max(1, -(-days // max(1, chunks))))
+    result = []
+    date = start_date
+    edge = round_date(start_date) + step
+    while edge < stop_date and len(result) < chunks - 1:
+        result.append((date, edge))
+        date = edge
+        edge += step
+    result.append((date, stop_date))
+    return result
+
+def split_time(start_date, stop_date, periods=('day',)):
+    """
+    Split start and stop datetime objects into a period of whole days, and the remainder on either end, and return it as a dictionary.
+
+    The time between 'start_edge' and 'stop_edge' is covered with the coarsest of periods that fit, under 'buckets'. These edges are whole days, or whole hours if 'hour' is in periods, and the remainders are the time outside of them.
     """
     result = {}
     offset = timedelta(0)
@@ -36,10 +104,18 @@ def split_time(start_date, stop_date):
     result['start_day'] = Arrow(
         start_date.year, start_date.month, start_date.day
     ).datetime + offset
-    result['remainder_start'] = result['start_day'] - start_date
     result['stop_day'] = Arrow(
         stop_date.year, stop_date.month, stop_date.day
     ).datetime
-    result['remainder_stop'] = stop_date - result['stop_day']
     result['n_days'] = (result['stop_day'] - result['start_day']).days
+    unit = 'hour' if 'hour' in periods else 'day'
+    result['start_edge'] = round_date(start_date, unit)
+    if result['start_edge'] < start_date:
+        result['start_edge'] = next_date(result['start_edge'], unit)
+    result['stop_edge'] = round_date(stop_date, unit)
+    if result['start_edge'] > result['stop_edge']:
+        result['start_edge'] = result['stop_edge'] = stop_date
+    result['remainder_start'] = result['start_edge'] - start_date
+    result['remainder_stop'] = stop_date - result['stop_edge']
+    result['buckets'] = cover_time(result['start_edge'], result['stop_edge'], periods)
     return result
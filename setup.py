@@ -16,11 +16,11 @@ setup(
         'Intended Audience :: Science/Research',
         'Topic :: Text Processing :: Linguistic',
         'License :: OSI Approved :: BSD License',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
     ],
     keywords='linguistics semantics diffusion timeseries',
     packages=['redicorpus', 'redicorpus.api', 'redicorpus.get'],
+    python_requires='>=3.5',
     package_data={'redicorpus' : ['data/*']},
     requires=[
             'datetime',
@@ -29,6 +29,7 @@ setup(
             'json',
             'logging',
             'nltk',
+            'numpy',
             'os',
             'pymongo',
             're',
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+from datetime import datetime
+import gzip
+import json
+from pkg_resources import resource_string
+import pytest
+from redicorpus import build, c, objects
+
+def get_comments():
+    data = json.loads(resource_string('test', 'data/comment.json').decode('utf-8'))
+    data['date'] = datetime.utcfromtimestamp(data['date'])
+    return [objects.Comment(dict(data, _id=_id)) for _id in ['build1', 'build2']]
+
+def test_shard_updates():
+    updates = build.shard_updates(get_comments())
+    key = [key for key in updates if key[0] == 'Body' and key[4] == 'String' and key[5] == 1][0]
+    assert updates[key]['$addToSet']['documents']['$each'] == ['build1', 'build2']
+    assert updates[key]['$inc']['count'] == len(updates[key]['$push']['polarity']['$each'])
+    coverage = [update for key, update in updates.items() if key[0] == 'Coverage']
+    assert [update['$inc']['comments'] for update in coverage] == [2]
+
+def test_merge_runs(tmpdir):
+    comments = get_comments()
+    paths = [str(tmpdir.join('a.run')), str(tmpdir.join('b.run'))]
+    build.write_run(paths[0], build.shard_updates(comments[:1]))
+    build.write_run(paths[1], build.shard_updates(comments[1:]))
+    merged = dict(build.merge_runs(paths))
+    combined = build.shard_updates(comments)
+    assert sorted(merged) == sorted([json.dumps(key) for key in combined])
+    for key, update in combined.items():
+        assert merged[json.dumps(key)]['$inc'] == update['$inc']
+
+def test_build_corpus(tmpdir):
+    data = json.loads(resource_string('test', 'data/raw_reddit.json').decode('utf-8'))
+    path = str(tmpdir.join('RC_build.gz'))
+    with gzip.open(path, 'wt') as f:
+        for _id in ['build3', 'build4']:
+            f.write(json.dumps(dict(data, id=_id)) + '\n')
+    c['Comment']['buildtest'].delete_many({})
+    c['Body']['buildtest'].delete_many({})
+    c['Coverage']['buildtest'].delete_many({})
+    assert build.build_corpus(path, source='buildtest', processes=2, shard_size=1, work_dir=str(tmpdir))
+    assert c['Comment']['buildtest'].count() == 2
+    document = c['Body']['buildtest'].find_one({'n' : 1, 'str_type' : 'String'})
+    assert sorted(document['documents']) == ['build3', 'build4']
+    assert document['count'] == len(document['polarity'])
+    assert c['Coverage']['buildtest'].find_one()['comments'] == 2
+    assert tmpdir.listdir() == [tmpdir.join('RC_build.gz')]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+from datetime import datetime
+import pytest
+from redicorpus import c, cache
+
+def test_prepare():
+    document = cache.prepare({'counts' : [1, 2, 3]})
+    assert document['hits'] == 0
+    assert document['size'] > 0
+    assert isinstance(document['accessed'], datetime)
+
+def test_hit_and_miss():
+    collection = c['BodyCache']['cachetest']
+    collection.delete_many({})
+    _id = collection.insert_one(cache.prepare({'counts' : [1]})).inserted_id
+    cache.hit(collection, _id)
+    cache.miss(collection)
+    assert collection.find_one({'_id' : _id})['hits'] == 1
+    stats = cache.stats('cachetest')['BodyCache']
+    assert stats['entries'] == 1
+    assert stats['hit_rate'] == 0.5
+
+def test_store():
+    collection = c['BodyCache']['cachetest']
+    collection.delete_many({})
+    c[cache.SIZE_DATABASE]['BodyCache'].delete_many({'_id' : 'cachetest'})
+    cache.store(collection, cache.prepare({'counts' : [1]}))
+    cache.store(collection, cache.prepare({'n' : 1, 'counts' : [1]}), {'n' : 1})
+    assert cache.running_size(collection) == cache.size_of(collection)
+    cache.store(collection, cache.prepare({'n' : 1, 'counts' : [1] * 100}), {'n' : 1})
+    assert collection.count() == 2
+    assert cache.running_size(collection) == cache.size_of(collection)
+    cache.store(collection, cache.prepare({'n' : 2, 'counts' : [1]}), {'n' : 2}, upsert=False)
+    assert collection.count() == 2
+    assert cache.running_size(collection) == cache.size_of(collection)
+
+def test_evict():
+    collection = c['BodyCache']['cachetest']
+    collection.delete_many({})
+    c[cache.SIZE_DATABASE]['BodyCache'].delete_many({'_id' : 'cachetest'})
+    for i in range(3):
+        cache.store(collection, cache.prepare({'counts' : [i] * 100}))
+    size = cache.size_of(collection)
+    assert cache.running_size(collection) == size
+    assert cache.evict(collection, size=size) == 0
+    assert cache.evict(collection, size=size - 1) == 1
+    assert collection.count() == 2
+    assert cache.running_size(collection) == cache.size_of(collection)
+    collection.delete_one({})
+    assert cache.evict(collection, size=cache.size_of(collection)) == 0
+    assert cache.running_size(collection) == cache.size_of(collection)
+    with pytest.raises(ValueError):
+        cache.evict(collection, size=0, policy='fifo')
+
+def test_invalidate():
+    collection = c['BodyCache']['cachetest']
+    collection.delete_many({})
+    collection.insert_one(cache.prepare({
+        'start_date' : datetime(2016,1,1),
+        'stop_date' : datetime(2016,1,10)
+    }))
+    collection.insert_one(cache.prepare({
+        'start_date' : datetime(2016,2,1),
+        'stop_date' : datetime(2016,2,10)
+    }))
+    assert cache.invalidate('cachetest', datetime(2016,1,5)) == 1
+    assert cache.invalidate('cachetest', datetime(2016,1,1), datetime(2016,2,1)) == 0
+    assert cache.invalidate('cachetest', datetime(2016,1,1), datetime(2016,2,2)) == 1
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+from pymongo.errors import DuplicateKeyError
+import pytest
+from redicorpus import c, dictionary
+
+def test_lru_cache():
+    cache = dictionary.LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert 'a' in cache
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+def test_term_cache():
+    cache = dictionary.TermCache(maxsize=10)
+    cache.warm('String', 1, [['the'], ['and']])
+    assert cache.get('String', 1, ('and',)) == 1
+    assert cache.get('String', 2, ('and',)) is None
+    cache.set('String', 2, ['of', 'the'], 5)
+    assert cache.get('String', 2, ('of', 'the')) == 5
+    stats = cache.stats()
+    assert stats[('String', 1)] == {'hits' : 1, 'misses' : 0, 'size' : 2}
+    assert stats[('String', 2)]['misses'] == 1
+
+def test_lookup():
+    assert dictionary.lookup('String', 1, ('and',)) == 0
+    assert dictionary.lookup('String', 1, ('xyzzyplugh',)) is None
+    assert dictionary.TERM_CACHE.stats()[('String', 1)]['hits']
+
+def test_id_allocator():
+    allocator = dictionary.IdAllocator(block_size=10)
+    first = allocator.allocate('String', 3)
+    assert allocator.allocate('String', 3) == first + 1
+    counter = c['Counter']['String'].find_one({'n' : 3})
+    assert counter['counter'] == first + 9
+
+def test_insert_terms():
+    term = ('xyzzy', 'plugh', 'frotz')
+    result = dictionary.insert_terms('String', 3, [term])
+    assert dictionary.lookup('String', 3, term) == result[term]
+    assert dictionary.insert_terms('String', 3, [term])[term] == result[term]
+    assert len(list(c['Dictionary']['String'].find({'term' : list(term), 'n' : 3}))) == 1
+
+def test_insert_terms_race():
+    term = ('xyzzy', 'plugh', 'zorkmid')
+    c['Dictionary']['String'].delete_many({'key' : dictionary.term_key(term), 'n' : 3})
+    winner = dictionary.ID_ALLOCATOR.allocate('String', 3)
+    c['Dictionary']['String'].insert_one({'ix' : winner, 'term' : list(term), 'key' : dictionary.term_key(term), 'n' : 3})
+    with pytest.raises(DuplicateKeyError):
+        c['Dictionary']['String'].insert_one({'ix' : winner + 1, 'term' : list(term), 'key' : dictionary.term_key(term), 'n' : 3})
+    assert dictionary.insert_terms('String', 3, [term])[term] == winner
+    assert dictionary.find_terms('String', 3, [term]) == {term : winner}
+    assert c['Dictionary']['String'].count({'key' : dictionary.term_key(term), 'n' : 3}) == 1
+
+def test_dictionary_snapshot(tmpdir):
+    term = ('xyzzy', 'plugh', 'frotz')
+    ix = dictionary.insert_terms('String', 3, [term])[term]
+    count = dictionary.export_snapshot('String', 3, str(tmpdir))
+    snapshot = dictionary.DictionarySnapshot(dictionary.snapshot_path('String', 3, str(tmpdir)))
+    assert len(snapshot) == count
+    assert snapshot.header['max_ix'] >= ix
+    assert snapshot.get(term) == ix
+    assert snapshot.get(('xyzzy', 'plugh', 'quux')) is None
+    index = dictionary.SnapshotIndex(str(tmpdir))
+    assert index.get('String', 3, term) == ix
+    assert index.get('String', 2, term) is None
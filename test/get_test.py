@@ -2,11 +2,17 @@
 
 from __future__ import absolute_import
 
+import asyncio
 from datetime import datetime
+import gzip
 import json
 from pkg_resources import resource_string
 import pytest
+from redicorpus import c
+from redicorpus.get import dump
+from redicorpus.get import fetcher as fetcher_module
 from redicorpus.get import reddit
+import time
 
 @pytest.fixture
 def get_data():
@@ -29,3 +35,87 @@ def test_client():
     generator = client.request()
     comment = next(generator)
     assert isinstance(comment, reddit.Response)
+
+def test_batches():
+    client = reddit.Client('test')
+    response = reddit.Response(get_data(), 'test')
+    client.request = lambda: iter([response] * 5)
+    batches = list(client.batches(size=2))
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert batches[0][0]['_id'] == 'd024gzv'
+    assert len(list(client.batches(size=5, window=0))) == 5
+
+class StubTransport(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requests = []
+
+    async def get(self, url, params=None):
+        self.requests.append((url, params))
+        if '/r/broken/' in url:
+            raise IOError("404 Client Error")
+        return self.pages[params.get('after')]
+
+class StubResult(object):
+
+    def ready(self):
+        return True
+
+def test_fetcher():
+    data = get_data()
+    data['created_utc'] = time.time()
+    children = [{'kind' : 't1', 'data' : dict(data, id=str(i))} for i in range(5)]
+    transport = StubTransport({
+        None : {'data' : {'children' : children[:3], 'after' : 't1_2'}},
+        't1_2' : {'data' : {'children' : children[3:], 'after' : None}}
+    })
+    batches = []
+    def dispatch(batch):
+        batches.append(batch)
+        return StubResult()
+    fetcher = fetcher_module.Fetcher(['test'], transport=transport, dispatch=dispatch, base_url='http://localhost', rate=100, interval=0, batch_size=2, batch_window=0.1)
+    asyncio.get_event_loop().run_until_complete(fetcher.run(walks=1))
+    assert [item['_id'] for batch in batches for item in batch] == ['0', '1', '2', '3', '4']
+    assert transport.requests[0][0] == 'http://localhost/r/test/comments.json'
+    assert transport.requests[1][1]['after'] == 't1_2'
+
+def test_fetcher_errors():
+    data = get_data()
+    data['created_utc'] = time.time()
+    transport = StubTransport({
+        None : {'data' : {'children' : [{'kind' : 't1', 'data' : data}], 'after' : None}}
+    })
+    batches = []
+    def dispatch(batch):
+        batches.append(batch)
+        return StubResult()
+    c['Comment']['LastUpdated'].delete_many({'source' : 'test'})
+    fetcher = fetcher_module.Fetcher(['broken', 'test'], transport=transport, dispatch=dispatch, base_url='http://localhost', rate=100, interval=0, batch_size=1, backoff=0.01)
+    asyncio.get_event_loop().run_until_complete(fetcher.run(walks=2))
+    assert len([url for url, _ in transport.requests if '/r/broken/' in url]) == 2
+    assert [item['_id'] for batch in batches for item in batch] == ['d024gzv']
+
+def test_rate_limit():
+    limit = fetcher_module.RateLimit(rate=20, burst=1)
+    started = time.monotonic()
+    loop = asyncio.get_event_loop()
+    for _ in range(3):
+        loop.run_until_complete(limit.acquire())
+    assert time.monotonic() - started >= 0.09
+
+def test_import_dump(tmpdir):
+    data = get_data()
+    path = str(tmpdir.join('RC_test.gz'))
+    with gzip.open(path, 'wt') as f:
+        for _id in ['dump1', 'dump2']:
+            f.write(json.dumps(dict(data, id=_id)) + '\n')
+        f.write(json.dumps(dict(data, id='dump3', created_utc=str(data['created_utc']))) + '\n')
+        f.write('not json\n')
+    c['Comment']['test'].delete_many({'_id' : {'$in' : ['dump1', 'dump2', 'dump3']}})
+    c['Comment']['ImportCheckpoint'].delete_many({})
+    with pytest.warns(UserWarning):
+        assert dump.import_dump(path, source='test', processes=2, batch_size=2, chunk_size=1) == 3
+    assert dump.get_checkpoint(path) == 4
+    assert c['Comment']['test'].find_one({'_id' : 'dump2'})['String']
+    assert dump.import_dump(path, source='test') == 0
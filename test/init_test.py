@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+import os
+import pytest
+import redicorpus
+
+def test_init():
+    client = redicorpus.init()
+    assert redicorpus.init() is client
+    assert redicorpus.get_client() is client
+    assert redicorpus._state['pid'] == os.getpid()
+    assert redicorpus.c['Counter']['String'].find_one({'n' : 1})
+
+def test_lazy_client():
+    assert redicorpus.c.address == redicorpus.get_client().address
+    assert redicorpus.c['Comment'].name == 'Comment'
+
+def test_setup_empty_database():
+    redicorpus.c.drop_database('CounterTest')
+    redicorpus.c.drop_database('DictionaryTest')
+    counters = redicorpus.c['CounterTest']
+    dictionaries = redicorpus.c['DictionaryTest']
+    redicorpus._setup_dictionaries(counters, dictionaries)
+    redicorpus._setup_dictionaries(counters, dictionaries)
+    trigrams = dict(redicorpus._load_stopwords())[3]
+    assert len(trigrams) > len(set([tuple(term) for term in trigrams]))
+    for str_type in redicorpus.STR_TYPE_LIST:
+        assert counters[str_type].count() == 3
+        assert dictionaries[str_type].count({'n' : 3}) == len(set([tuple(term) for term in trigrams]))
+        assert counters[str_type].find_one({'n' : 3})['counter'] == len(trigrams) - 1
+        assert dictionaries[str_type].find_one({'term' : ['i', 'do', "n't"], 'n' : 3})['ix'] == trigrams.index(['i', 'do', "n't"])
+    redicorpus.c.drop_database('CounterTest')
+    redicorpus.c.drop_database('DictionaryTest')
+
+def test_init_worker():
+    settings = redicorpus.worker_settings()
+    state = dict(redicorpus._state)
+    rollup_list = redicorpus.ROLLUP_LIST
+    try:
+        redicorpus.init_worker(dict(settings, ROLLUP_LIST=['hour']))
+        assert redicorpus.ROLLUP_LIST == ['hour']
+        assert redicorpus._state['uri'] == settings['uri']
+        assert redicorpus._state['initialized']
+        assert redicorpus.c['Counter']['String'].find_one({'n' : 1})
+    finally:
+        redicorpus.ROLLUP_LIST = rollup_list
+        redicorpus._state.update(state)
@@ -3,9 +3,12 @@
 from arrow import Arrow
 from datetime import datetime
 import json
+import numpy as np
+import pickle
 from pkg_resources import resource_string
 import pytest
-from redicorpus import c, objects
+import redicorpus
+from redicorpus import c, objects, snapshot
 import time
 
 gram_length_list = [1, 2, 3]
@@ -30,6 +33,19 @@ def test_lemma():
     obj = objects.Lemma('fried')
     assert obj.__totuple__() == ('fry', 'fried', 'VBN', 'Lemma')
 
+def test_token_store():
+    store = objects.TokenStore.__fromtagged__(objects.Lemma, [('fried', 'VBN'), ('pickles', 'NNS')])
+    assert len(store) == 2
+    assert isinstance(store[0], objects.Lemma)
+    assert store.__totuples__() == [('fry', 'fried', 'VBN', 'Lemma'), ('pickle', 'pickles', 'NNS', 'Lemma')]
+    gram = next(store.grams(2))
+    assert len(gram) == 2
+    assert gram.term == ('fry', 'pickle')
+    assert gram.raw == ('fried', 'pickles')
+    assert gram.str_type == objects.Lemma
+    assert objects.Gram(gram.gram).term == gram.term
+    assert len(store.strings) == 6
+
 def test_dict_like():
     with pytest.raises(TypeError):
         objects.DictLike().__fromdict__('blue')
@@ -48,6 +64,7 @@ def test_comment():
     assert isinstance(comment, objects.DictLike)
     assert len(comment)
     assert comment['_id'] == 'd024gzv'
+    assert comment['String'].strings is comment['Lemma'].strings
     assert dict(comment)
     assert str(comment)
     assert comment.keys()
@@ -56,6 +73,33 @@ def test_comment():
     comment.insert()
     document = c['Comment']['test'].find_one()
     assert isinstance(objects.Comment(document)['Lemma'][0], objects.Lemma)
+    assert [item.term for item in objects.Comment(document)['Stem']] == [item.term for item in comment['Stem']]
+
+def test_comment_bulk():
+    with open('test/data/comment.json', 'r') as f:
+        data = json.load(f)
+    data['_id'] = 'd024gzw'
+    data['date'] = datetime.utcfromtimestamp(data['date'])
+    c['Comment']['test'].delete_one({'_id' : 'd024gzw'})
+    comment = objects.Comment(data)
+    grams = comment.__aggregategrams__()
+    assert len(grams) < sum(grams.values())
+    assert comment.insert(bulk=True)
+    for str_type in objects.StringLike.__subclasses__():
+        document = c['Body']['test'].find_one({'str_type' : str_type.__name__, 'documents' : 'd024gzw'})
+        assert document
+        assert document['count'] == len(document['polarity'])
+
+def test_comment_sketch():
+    with open('test/data/comment.json', 'r') as f:
+        data = json.load(f)
+    data['_id'] = 'd024gzx'
+    data['date'] = datetime.utcfromtimestamp(data['date'])
+    c['Comment']['test'].delete_one({'_id' : 'd024gzx'})
+    assert objects.Comment(data).insert(bulk=True, sketch=True)
+    document = c['Body']['test'].find_one({'user_sketch' : {'$exists' : True}})
+    assert document
+    assert len(objects.HyperLogLog.__fromdb__(document['user_sketch'])) == 1
 
 def test_update_body():
     for str_type in objects.StringLike.__subclasses__():
@@ -64,6 +108,15 @@ def test_update_body():
         assert len(document['users']) == 1
         assert document['count'] == len(document['polarity'])
 
+def test_comment_neighbours():
+    comment = objects.Comment(c['Comment']['test'].find_one({'_id' : 'd024gzv'}))
+    neighbours = comment.__aggregateneighbours__()
+    assert neighbours
+    for (str_type, n, term, position, neighbour), count in neighbours.items():
+        assert 0 < abs(position) <= redicorpus.COOCCURRENCE_WINDOW
+        assert neighbours[(str_type, n, neighbour, -position, term)] == count
+    assert c['Cooccurrence']['test'].find_one({'position' : 1})
+
 def test_update_dictionary():
     for str_type in objects.StringLike.__subclasses__():
         for gram_length in gram_length_list:
@@ -82,12 +135,30 @@ def test_get_comment():
     comment = objects.get_comment('d024gzv', 'test')
     assert comment
 
+def test_get_comments():
+    comments = dict(objects.get_comments(['d024gzv', 'd024gzw', 'missing'], 'test', objects.Stem, page_size=1))
+    assert sorted(comments) == ['d024gzv', 'd024gzw']
+    assert isinstance(comments['d024gzv'], objects.TokenStore)
+    assert [item.term for item in comments['d024gzv']] == [item.term for item in objects.get_comment('d024gzv', 'test')['Stem']]
+
 def test_insert_comment():
     c['Comment']['test'].delete_one({'_id' : 'd024gzv'})
     data = json.loads(resource_string('test', 'data/comment.json').decode('utf-8'))
     obj = objects.insert_comment.delay(data)
     assert obj.get()
 
+def test_insert_comments():
+    data = json.loads(resource_string('test', 'data/comment.json').decode('utf-8'))
+    response_list = []
+    for _id in ['d024gzy', 'd024gzz']:
+        c['Comment']['test'].delete_one({'_id' : _id})
+        response_list.append(dict(data, _id=_id))
+    assert objects.insert_comments.delay(response_list).get() == 2
+    with pytest.warns(UserWarning):
+        assert objects.insert_batch([objects.Comment(dict(data, _id='d024gzy'))]) == 0
+    document = c['Body']['test'].find_one({'documents' : 'd024gzy'})
+    assert 'd024gzz' in document['documents']
+
 def test_array_like():
     with pytest.raises(ValueError):
         objects.ArrayLike(n=1, str_type='Frayed')
@@ -103,6 +174,34 @@ def test_array_like():
     assert array[objects.String('the')]
     array['the'] = 1
     assert array[objects.String('the')]
+    array[9] = 0.5
+    assert len(array) == 10
+    assert array[8] == 0
+    array += 1
+    assert array[9] == 1.5
+
+def test_sparse_array_like():
+    array = objects.ArrayLike([0, 0, 3, 0], 1, objects.String, sparse=True)
+    assert array._values == {2 : 3}
+    assert array * 2 == [0, 0, 6, 0]
+    array[100] = 1
+    assert len(array) == 101
+    assert len(array._values) == 2
+    result = array + objects.ArrayLike([1], 1, objects.String)
+    assert result.tolist()[:3] == [1, 0, 6]
+    assert not result.sparse
+
+def test_count_types():
+    counts = objects.ArrayLike([2, 1, 0, 1], 1, objects.String)
+    documents = objects.ArrayLike([{'a', 'b'}, {'a'}], 1, objects.String, null=set())
+    users = objects.ArrayLike([{'u'}, {'u', 'v'}, set(), {'v'}], 1, objects.String, null=set())
+    assert list(objects.Count(counts, documents, users).get()) == [2, 1, 0, 1]
+    assert list(objects.Tf(counts, documents, users).get()) == [0.5, 0.25, 0, 0.25]
+    assert list(objects.Activation(counts, documents, users).get()) == [0.5, 1, 0, 0.5]
+    assert objects.Count(counts, documents, users).count_documents() == [2, 1, 0, 0]
+    tfidf = objects.Tfidf(counts, documents, users).get()
+    frequencies = objects.ArrayLike([2, 1, 0, 0], 1, objects.String)
+    assert list(objects.Tfidf(counts, frequencies, users, n_documents=2).get()) == list(tfidf)
 
 def test_vector():
     with pytest.raises(ValueError):
@@ -122,13 +221,132 @@ def test_vector():
 def test_get_body():
     vector = objects.get_body(source='test', start_date=Arrow(2016,2,15).datetime, stop_date=Arrow(2016,2,18).datetime)
     assert vector
+    vector = objects.get_body(source='test', count_type=objects.Activation, start_date=Arrow(2016,2,15).datetime, stop_date=Arrow(2016,2,18).datetime, sketch=True)
+    assert len(vector)
+    vector = objects.get_body(source='test', count_type=objects.Tfidf, start_date=Arrow(2016,2,15).datetime, stop_date=Arrow(2016,2,18).datetime, aggregate=True)
+    assert len(vector)
+    summed = objects.get_body(source='test', count_type=objects.Activation, start_date=Arrow(2016,2,15).datetime, stop_date=Arrow(2016,2,18).datetime, sketch=True, aggregate=True)
+    assert summed.tolist() == objects.get_body(source='test', count_type=objects.Activation, start_date=Arrow(2016,2,15).datetime, stop_date=Arrow(2016,2,18).datetime, sketch=True).tolist()
+
+def test_get_body_workers():
+    start_date, stop_date = Arrow(2016,2,15).datetime, Arrow(2016,2,18).datetime
+    c['BodyCache']['test'].delete_many({'start_date' : start_date})
+    vector = objects.get_body(source='test', count_type=objects.Tfidf, start_date=start_date, stop_date=stop_date)
+    c['BodyCache']['test'].delete_many({'start_date' : start_date})
+    parallel = objects.get_body(source='test', count_type=objects.Tfidf, start_date=start_date, stop_date=stop_date, workers=3)
+    assert parallel.tolist() == vector.tolist()
+    chunk = objects.count_range('test', 1, objects.String, False, False, start_date, Arrow(2016,2,16).datetime)
+    assert pickle.loads(pickle.dumps(chunk)) == chunk
+    assert sum(chunk['counts']) <= sum(objects.count_range('test', 1, objects.String, False, False, start_date, stop_date)['counts'])
+
+def test_get_body_async():
+    start_date, stop_date = Arrow(2016,2,15).datetime, Arrow(2016,2,18).datetime
+    vector = objects.get_body(source='test', start_date=start_date, stop_date=stop_date)
+    result = objects.get_body(source='test', start_date=start_date, stop_date=stop_date, workers=3, asynchronous=True)
+    assert result.get() == vector.tolist()
+
+def test_vector_snapshot(tmpdir, monkeypatch):
+    monkeypatch.setattr(snapshot, 'SNAPSHOT_DIR', str(tmpdir))
+    start_date, stop_date = Arrow(2016,2,15).datetime, Arrow(2016,2,18).datetime
+    vector = objects.get_body(source='test', count_type=objects.Tfidf, start_date=start_date, stop_date=stop_date, snapshot=True)
+    assert len(tmpdir.join('test').listdir()) == 1
+    mapped = objects.get_body(source='test', count_type=objects.Tfidf, start_date=start_date, stop_date=stop_date, snapshot=True)
+    assert isinstance(mapped._data, np.memmap)
+    assert mapped.tolist() == vector.tolist()
+    snapshot.touch('test', Arrow(2016,2,16).datetime)
+    recounted = objects.get_body(source='test', count_type=objects.Tfidf, start_date=start_date, stop_date=stop_date, snapshot=True)
+    assert not isinstance(recounted._data, np.memmap)
+
+def test_vector_cache():
+    start_date = Arrow(2016,2,15).datetime
+    c['BodyCache']['test'].delete_many({'start_date' : start_date})
+    vector = objects.Vector('test', 1, objects.String, objects.Count, start_date, Arrow(2016,2,17).datetime)
+    cached = c['BodyCache']['test'].find_one({'start_date' : start_date})
+    assert cached['counts'] == vector.tolist()
+    assert not cached['extended']
+    extended = objects.Vector('test', 1, objects.String, objects.Count, start_date, Arrow(2016,2,18).datetime)
+    assert len(list(c['BodyCache']['test'].find({'start_date' : start_date}))) == 1
+    cached = c['BodyCache']['test'].find_one({'start_date' : start_date})
+    assert cached['stop_date'] == datetime(2016,2,18)
+    assert cached['extended']
+    assert sum(extended) >= sum(vector)
+    objects.Vector('test', 1, objects.String, objects.Activation, start_date, Arrow(2016,2,18).datetime)
+    assert c['BodyCache']['test'].find_one({'start_date' : start_date, 'stop_date' : datetime(2016,2,18)})['extended'] is False
+    objects.Vector('test', 1, objects.String, objects.Count, start_date, Arrow(2016,2,18).datetime, aggregate=True)
+    assert c['BodyCache']['test'].count({'start_date' : start_date, 'aggregate' : True}) == 1
+
+def test_build_rollups():
+    objects.build_rollups('test', 'month', Arrow(2016,2,1).datetime, Arrow(2016,3,1).datetime)
+    document = c['BodyMonth']['test'].find_one({'str_type' : 'String'})
+    assert document['date'] == datetime(2016, 2, 1)
+    assert document['count']
+    assert 'polarity' not in document
+    assert 'users' not in document
+    assert len(objects.HyperLogLog.__fromdb__(document['user_sketch']))
+    redicorpus.ROLLUP_LIST.append('month')
+    try:
+        vector = objects.get_body(source='test', start_date=Arrow(2016,1,31).datetime, stop_date=Arrow(2016,3,2).datetime)
+        assert len(vector)
+        vector = objects.get_body(source='test', count_type=objects.Activation, start_date=Arrow(2016,1,31).datetime, stop_date=Arrow(2016,3,2).datetime, sketch=True)
+        assert len(vector)
+    finally:
+        redicorpus.ROLLUP_LIST.remove('month')
+
+def test_hourly_records():
+    data = json.loads(resource_string('test', 'data/comment.json').decode('utf-8'))
+    c['Comment']['test'].delete_one({'_id' : 'd024hour'})
+    redicorpus.ROLLUP_LIST.append('hour')
+    try:
+        assert objects.insert_batch([objects.Comment(dict(data, _id='d024hour', date=1458439073.0))]) == 1
+        document = c['BodyHour']['test'].find_one({'documents' : 'd024hour'})
+        assert document['date'] == datetime(2016, 3, 20, 1)
+        assert document['users'] == [data['user']]
+        assert 'user_sketch' not in document
+        # Only the hourly records are left to count from
+        c['Comment']['test'].delete_one({'_id' : 'd024hour'})
+        vector = objects.get_body(source='test', start_date=Arrow(2016,3,20,1).datetime, stop_date=Arrow(2016,3,20,2).datetime)
+        assert sum(vector) == sum([record['count'] for record in c['BodyHour']['test'].find({'date' : datetime(2016, 3, 20, 1), 'n' : 1, 'str_type' : 'String'})])
+        assert sum(vector)
+    finally:
+        redicorpus.ROLLUP_LIST.remove('hour')
 
 def test_map():
     mapping = objects.Map(gram=objects.String('proof'), source='test')
+    neighbour = objects.Map(gram=objects.String('proof'), source='test', position=1)
+    assert abs(sum(neighbour) - 1) < 1e-9
+
+def test_map_coverage():
+    data = json.loads(resource_string('test', 'data/comment.json').decode('utf-8'))
+    for _id in ['d024cov1', 'd024cov2']:
+        c['Comment']['test'].delete_one({'_id' : _id})
+    c['Cooccurrence']['test'].delete_many({'date' : {'$gte' : datetime(2016, 4, 1), '$lt' : datetime(2016, 4, 3)}})
+    c['Coverage']['test'].delete_many({'_id' : {'$gte' : datetime(2016, 4, 1), '$lt' : datetime(2016, 4, 3)}})
+    window = redicorpus.COOCCURRENCE_WINDOW
+    redicorpus.COOCCURRENCE_WINDOW = 0
+    try:
+        objects.insert_batch([objects.Comment(dict(data, _id='d024cov1', date=1459475873.0))])
+    finally:
+        redicorpus.COOCCURRENCE_WINDOW = window
+    objects.insert_batch([objects.Comment(dict(data, _id='d024cov2', date=1459562273.0))])
+    start_date, middle_date, stop_date = Arrow(2016,4,1).datetime, Arrow(2016,4,2).datetime, Arrow(2016,4,3).datetime
+    assert objects.neighbour_days('test', start_date, stop_date, window) == [(middle_date, stop_date)]
+    for position in [0, 1]:
+        # The first day is counted from comments, and the second from neighbour counts
+        counts = objects.count_map('test', objects.String, ('proof',), position, window, start_date, stop_date)
+        single = objects.count_map('test', objects.String, ('proof',), position, window, middle_date, stop_date)
+        assert single
+        assert counts == dict([(term, count * 2) for term, count in single.items()])
+    objects.Map(gram=objects.String('proof'), source='test', position=1, start_date=start_date, stop_date=stop_date)
+    assert c['Map']['test'].find_one({'term' : ['proof'], 'position' : 1, 'start_date' : start_date})['window'] == window
 
 def test_get_map():
     objects.get_map(gram=objects.String('proof'), source='test', n=1)
 
+def test_get_map_async():
+    mapping = objects.get_map(gram=objects.String('proof'), source='test', n=1, position=1)
+    result = objects.get_map(gram=objects.String('proof'), source='test', n=1, position=1, workers=2, asynchronous=True)
+    assert result.get() == mapping.tolist()
+
 def test_get_datelimit():
     assert objects.get_datelimit('test') < datetime.utcnow()
 
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+import pytest
+from redicorpus.sketch import HyperLogLog
+
+def test_estimate():
+    assert len(HyperLogLog()) == 0
+    assert len(HyperLogLog(['a', 'a', 'b'])) == 2
+    sketch = HyperLogLog(range(10000))
+    assert abs(len(sketch) - 10000) < 500
+
+def test_merge():
+    left = HyperLogLog(range(5000))
+    right = HyperLogLog(range(2500, 7500))
+    assert abs(len(left | right) - 7500) < 375
+    assert len(HyperLogLog.union([left, None, right])) == len(left | right)
+    left.merge(right)
+    assert len(left) == len(left | right)
+
+def test_db():
+    sketch = HyperLogLog(range(100))
+    assert len(HyperLogLog.__fromdb__(sketch.__todb__())) == len(sketch)
+    register, rank = HyperLogLog.position('user')
+    assert HyperLogLog.update('user_sketch', 'user') == {'user_sketch.{}'.format(register) : rank}
+    assert HyperLogLog.__fromdb__({str(register) : rank}).registers[register] == rank
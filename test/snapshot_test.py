@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+from datetime import datetime
+import numpy as np
+import os
+import pytest
+from redicorpus import c, snapshot
+from redicorpus import exceptions as e
+
+class String(object):
+    pass
+
+class Tfidf(object):
+    pass
+
+def test_write_read(tmpdir):
+    fields = snapshot.key('test', 1, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1))
+    path = snapshot.path_of(fields, str(tmpdir))
+    assert path == os.path.join(str(tmpdir), 'test', '1-String-Tfidf-set-20160101T000000-20160201T000000.vec')
+    snapshot.write(path, np.array([0.5, 1.5, 2.5]), fields)
+    values, header = snapshot.read(path)
+    assert isinstance(values, np.memmap)
+    assert values.tolist() == [0.5, 1.5, 2.5]
+    assert header['count_type'] == 'Tfidf'
+    assert values.offset % snapshot.ALIGNMENT == 0
+    values[0] = 9
+    assert snapshot.read(path)[0][0] == 0.5
+    assert snapshot.load('test', 1, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1), directory=str(tmpdir)).tolist() == [0.5, 1.5, 2.5]
+    with pytest.raises(e.DocumentNotFound):
+        snapshot.load('test', 2, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1), directory=str(tmpdir))
+    with pytest.raises(TypeError):
+        snapshot.write(path, np.array([set()]), fields)
+
+def test_touch(tmpdir):
+    c['Snapshot']['snapshottest'].delete_many({})
+    fields = snapshot.key('snapshottest', 1, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1))
+    snapshot.write(snapshot.path_of(fields, str(tmpdir)), np.arange(3), dict(fields, generation=snapshot.generation('snapshottest', datetime(2016,1,1), datetime(2016,2,1))))
+    assert snapshot.load('snapshottest', 1, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1), directory=str(tmpdir)).tolist() == [0, 1, 2]
+    snapshot.touch('snapshottest', datetime(2016,2,1,12), datetime(2016,2,3))
+    snapshot.touch('snapshottest', datetime(2016,2,2))
+    assert c['Snapshot']['snapshottest'].count() == 2
+    assert snapshot.generation('snapshottest', datetime(2016,2,1), datetime(2016,2,3)) == 3
+    assert snapshot.load('snapshottest', 1, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1), directory=str(tmpdir)).tolist() == [0, 1, 2]
+    snapshot.touch('snapshottest', datetime(2016,1,31,23))
+    with pytest.raises(e.DocumentNotFound):
+        snapshot.load('snapshottest', 1, String, Tfidf, datetime(2016,1,1), datetime(2016,2,1), directory=str(tmpdir))
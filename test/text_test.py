@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+
+from __future__ import absolute_import
+
+import pytest
+from redicorpus import text
+
+def test_singletons():
+    assert text.get_stemmer() is text.get_stemmer()
+    assert text.get_lemmatizer() is text.get_lemmatizer()
+    assert text.get_tagger() is text.get_tagger()
+
+def test_tag():
+    assert text.tag(['fried']) == [('fried', 'VBN')]
+    assert text.tag_word('fried') == 'VBN'
+
+def test_stem():
+    assert text.stem('fried') == 'fri'
+    hits = text.cache_info()['stem'].hits
+    assert text.stem('fried') == 'fri'
+    assert text.cache_info()['stem'].hits == hits + 1
+
+def test_lemmatize():
+    assert text.lemmatize('fried', 'VBN') == 'fry'
+    assert text.lemmatize('fried') == 'fried'
+
+def test_tokenize():
+    assert text.tokenize('Fried pickles') == [('fried', 'VBN'), ('pickles', 'NNS')]
+
+def test_interner():
+    interner = text.Interner()
+    ix = interner.intern('fried')
+    assert interner.intern('fried') == ix
+    assert interner[ix] == 'fried'
+    assert len(interner) == 1
@@ -28,3 +28,50 @@ def test_split_time():
     assert result['remainder_stop'] == timedelta(0, 7320)
     assert result['start_day'] == Arrow(1, 1, 2, 0, 0).datetime
     assert result['stop_day'] == Arrow(2, 2, 2, 0, 0).datetime
+
+def test_round_date():
+    date = datetime(2016, 2, 17, 13, 5)
+    assert tools.round_date(date) == datetime(2016, 2, 17)
+    assert tools.round_date(date, 'week') == datetime(2016, 2, 15)
+    assert tools.round_date(date, 'month') == datetime(2016, 2, 1)
+    assert tools.next_date(datetime(2016, 12, 1), 'month') == datetime(2017, 1, 1)
+    with pytest.raises(ValueError):
+        tools.round_date(date, 'fortnight')
+
+def test_cover_time():
+    buckets = tools.cover_time(datetime(2016, 1, 30), datetime(2016, 3, 14), ['week', 'month'])
+    assert [period for period, _, _ in buckets] == ['day'] * 2 + ['month'] + ['day'] * 6 + ['week']
+    assert buckets[0][1] == datetime(2016, 1, 30)
+    assert buckets[-1][2] == datetime(2016, 3, 14)
+    result = tools.split_time(Arrow(2016, 1, 1, 1).datetime, Arrow(2016, 1, 3, 1).datetime)
+    assert result['buckets'] == [('day', Arrow(2016, 1, 2).datetime, Arrow(2016, 1, 3).datetime)]
+
+def test_chunk_time():
+    chunks = tools.chunk_time(datetime(2016, 1, 1, 12), datetime(2016, 1, 11), 3)
+    assert chunks == [
+        (datetime(2016, 1, 1, 12), datetime(2016, 1, 5)),
+        (datetime(2016, 1, 5), datetime(2016, 1, 9)),
+        (datetime(2016, 1, 9), datetime(2016, 1, 11))
+    ]
+    assert tools.chunk_time(datetime(2016, 1, 1), datetime(2016, 1, 1, 6), 4) == [(datetime(2016, 1, 1), datetime(2016, 1, 1, 6))]
+    assert tools.chunk_time(datetime(2016, 2, 16, 12), datetime(2016, 2, 18, 12), 1) == [(datetime(2016, 2, 16, 12), datetime(2016, 2, 18, 12))]
+    chunks = tools.chunk_time(datetime(2016, 1, 1, 12), datetime(2016, 1, 8, 12), 2)
+    assert chunks == [
+        (datetime(2016, 1, 1, 12), datetime(2016, 1, 5)),
+        (datetime(2016, 1, 5), datetime(2016, 1, 8, 12))
+    ]
+
+def test_split_time_hours():
+    result = tools.split_time(
+        Arrow(2016, 1, 13, 5, 30).datetime, Arrow(2016, 1, 15, 3, 10).datetime, ['hour']
+    )
+    assert result['remainder_start'] == timedelta(0, 1800)
+    assert result['remainder_stop'] == timedelta(0, 600)
+    periods = [period for period, _, _ in result['buckets']]
+    assert periods == ['hour'] * 18 + ['day'] + ['hour'] * 3
+    result = tools.split_time(
+        Arrow(2016, 1, 13, 5, 30).datetime, Arrow(2016, 1, 13, 9, 50).datetime
+    )
+    assert result['buckets'] == []
+    assert result['remainder_start'] == timedelta(0, 15600)
+    assert not result['remainder_stop']